@@ -0,0 +1,43 @@
+"""
+Benchmarks decoding the structured columns of an import row: legacy eval() and literal_eval against the JSON codec.
+Run from the repository root: python -m benchmarks.bench_column_codec [rows]
+"""
+import ast
+import sys
+import time
+
+from util import codec
+
+DEFAULT_ROWS = 1_000_000
+
+SAMPLE_ROW = {
+    'embeds': [{'type': 'rich', 'title': 'Patch notes', 'description': 'Fixed **things**.', 'color': 3066993, 'fields': [{'name': 'Version', 'value': '1.2.3', 'inline': True}]}],
+    'reactions': [('👍', 4), ('<:pog:123456789012345678>', 2)],
+    'attachments': ['https://cdn.discordapp.com/attachments/1/2/image.png'],
+    'stickers': [],
+    'components': [{'type': 1, 'children': [{'type': 2, 'style': 5, 'label': 'Open', 'emoji': None, 'custom_id': None, 'url': 'https://example.com', 'disabled': False}]}],
+}
+
+
+def bench(label: str, columns: list, decode, rows: int):
+    start = time.perf_counter()
+    for _ in range(rows):
+        for column in columns:
+            decode(column)
+    elapsed = time.perf_counter() - start
+    print(f'{label:>14} {elapsed:>10.2f} {elapsed / rows * 1e6:>10.2f}')
+
+
+def main(rows: int):
+    legacy = [str(value) for value in SAMPLE_ROW.values()]
+    current = [codec.encode_column(value) for value in SAMPLE_ROW.values()]
+    print(f'{rows} rows, {len(current)} structured columns each')
+    print(f'{"decoder":>14} {"seconds":>10} {"us/row":>10}')
+    bench('eval', legacy, eval, rows)
+    bench('literal_eval', legacy, ast.literal_eval, rows)
+    bench('codec v1', legacy, lambda text: codec.decode_column(text, codec.LEGACY_VERSION), rows)
+    bench('codec v2', current, codec.decode_column, rows)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_ROWS)
@@ -0,0 +1,103 @@
+"""
+Measures the client's cache footprint in the default and lean gateway modes against a synthetic large-guild fixture.
+Guild payloads are fed straight into the client's connection state the way the gateway would deliver them: with the
+member list and presences (as after chunking) when those intents are on, without them otherwise. Then a burst of
+message events is replayed. Idle is the traced memory after the guilds are loaded, peak is the highest traced memory
+during the message burst.
+Run from the repository root: python -m benchmarks.bench_gateway_memory [--guilds N] [--members N] [--messages N]
+"""
+import argparse
+import asyncio
+import gc
+import tracemalloc
+
+import discord
+
+from util import gateway
+
+TIMESTAMP = '2024-01-01T00:00:00+00:00'
+
+
+def user_payload(user_id: int) -> dict:
+    return {'id': str(user_id), 'username': f'user{user_id}', 'global_name': f'User {user_id}', 'discriminator': '0', 'avatar': None}
+
+
+def guild_payload(guild_id: int, members: int, channels: int, threads: int, intents: discord.Intents) -> dict:
+    """
+    Builds a GUILD_CREATE payload for a synthetic guild.
+    :param guild_id: Id of the guild.
+    :param members: Number of members, only included when the members intent is on.
+    :param channels: Number of text channels.
+    :param threads: Number of active threads.
+    :param intents: Intents the payload is delivered under.
+    :return: Guild payload.
+    """
+    roles = [{'id': str(guild_id + i), 'name': f'role{i}', 'permissions': '0', 'position': i, 'color': 0, 'hoist': False,
+              'managed': False, 'mentionable': False, 'flags': 0} for i in range(100)]
+    channel_payloads = [{'id': str(guild_id + 1_000 + i), 'type': 0, 'name': f'channel{i}', 'position': i, 'guild_id': str(guild_id),
+                         'permission_overwrites': [], 'nsfw': False, 'parent_id': None, 'last_message_id': None} for i in range(channels)]
+    thread_payloads = [{'id': str(guild_id + 100_000 + i), 'type': 11, 'name': f'thread{i}', 'guild_id': str(guild_id),
+                        'parent_id': channel_payloads[i % channels]['id'], 'owner_id': str(guild_id + 10_000_000 + i % max(1, members)),
+                        'member_count': 2, 'message_count': 10,
+                        'thread_metadata': {'archived': False, 'auto_archive_duration': 1440, 'archive_timestamp': TIMESTAMP, 'locked': False}}
+                       for i in range(threads)]
+    data = {'id': str(guild_id), 'name': f'guild{guild_id}', 'owner_id': str(guild_id + 10_000_000), 'roles': roles,
+            'emojis': [{'id': str(guild_id + 200_000 + i), 'name': f'emoji{i}', 'animated': False, 'available': True, 'require_colons': True, 'managed': False, 'roles': []} for i in range(200)],
+            'stickers': [], 'features': [], 'member_count': members, 'large': True, 'premium_tier': 2, 'verification_level': 0,
+            'channels': channel_payloads, 'threads': thread_payloads, 'members': [], 'presences': []}
+    if intents.members:
+        data['members'] = [{'user': user_payload(guild_id + 10_000_000 + i), 'roles': [roles[i % 100]['id']], 'joined_at': TIMESTAMP,
+                            'deaf': False, 'mute': False, 'flags': 0} for i in range(members)]
+    if intents.presences:
+        # roughly a tenth of a large guild is online
+        data['presences'] = [{'user': {'id': str(guild_id + 10_000_000 + i)}, 'status': 'online', 'activities': [], 'client_status': {'desktop': 'online'}}
+                             for i in range(0, members, 10)]
+    return data
+
+
+def message_payload(guild_id: int, channel_id: int, message_id: int, author_id: int) -> dict:
+    return {'id': str(message_id), 'channel_id': str(channel_id), 'guild_id': str(guild_id), 'author': user_payload(author_id),
+            'member': {'roles': [], 'joined_at': TIMESTAMP, 'deaf': False, 'mute': False, 'flags': 0}, 'content': f'message {message_id}',
+            'timestamp': TIMESTAMP, 'edited_timestamp': None, 'tts': False, 'mention_everyone': False, 'mentions': [],
+            'mention_roles': [], 'attachments': [], 'embeds': [], 'pinned': False, 'type': 0}
+
+
+async def measure(lean: bool, args) -> (float, float):
+    options = gateway.client_options(lean)
+    gc.collect()
+    tracemalloc.start()
+    client = discord.Client(**options)
+    state = client._connection
+    guild_ids = [(i + 1) << 32 for i in range(args.guilds)]
+    for guild_id in guild_ids:
+        # payloads are built one at a time and dropped, only what the client keeps is measured
+        state._add_guild_from_data(guild_payload(guild_id, args.members, args.channels, args.threads, options['intents']))
+    gc.collect()
+    idle, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    for i in range(args.messages):
+        guild_id = guild_ids[i % len(guild_ids)]
+        state.parse_message_create(message_payload(guild_id, guild_id + 1_000 + i % args.channels, (1 << 60) + i, guild_id + 10_000_000 + i % max(1, args.members)))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    await client.close()
+    return idle, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Gateway cache memory in the default and lean modes.')
+    parser.add_argument('--guilds', type=int, default=5)
+    parser.add_argument('--members', type=int, default=20_000, help='Members per guild.')
+    parser.add_argument('--channels', type=int, default=200, help='Text channels per guild.')
+    parser.add_argument('--threads', type=int, default=500, help='Active threads per guild.')
+    parser.add_argument('--messages', type=int, default=50_000, help='Message events replayed after startup.')
+    args = parser.parse_args()
+    print(f'{args.guilds} guilds x {args.members} members, {args.channels} channels, {args.threads} threads, {args.messages} message events')
+    print(f'{"mode":>8} {"idle MB":>9} {"peak MB":>9}')
+    for lean in (False, True):
+        idle, peak = asyncio.run(measure(lean, args))
+        print(f'{"lean" if lean else "default":>8} {idle / 1e6:>9.1f} {peak / 1e6:>9.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""
+Benchmarks the export and import pipeline end to end against the local fake Discord backend in fake_discord.
+Stages: fetch (fetch_messages), export (export_messages into write_messages_csv), associate (associate_thread on every
+thread sysmessage) and import (handle_messages of the export). Reports messages per second, peak traced memory and API calls.
+The export and import stages fail if they do not write and import exactly one row per fetched message.
+Run from the repository root: python -m benchmarks.bench_pipeline [sizes...] [--latency S] [--rate-limit-ratio R] ...
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks import fake_discord
+from util import utility, jobs, webhooks, metrics
+
+DEFAULT_SIZES = [10_000]
+STAGES = ('fetch', 'export', 'associate', 'import')
+
+
+def count_rows(file_name: str) -> int:
+    with open(file_name, 'rb') as file:
+        return sum(1 for _ in utility.open_rows(file))
+
+
+async def checked_export(channel, file_name: str, slices=1) -> (int, int):
+    """
+    Exports the channel and checks that every fetched message was written as exactly one row.
+    :return: Tuple of the total message count and fetched message count.
+    """
+    _, total, fetched = await utility.export_messages(channel, file_name, slices=slices)
+    exported = count_rows(file_name)
+    assert exported == fetched, f'{exported} rows exported for {fetched} fetched messages'
+    return total, fetched
+
+
+async def stage_fetch(channel, args, directory):
+    messages, total, fetched = await utility.fetch_messages(channel)
+    return total
+
+
+async def stage_export(channel, args, directory):
+    total, fetched = await checked_export(channel, os.path.join(directory, f'{channel.id}.csv'), args.slices)
+    return total
+
+
+async def stage_associate(channel, args, directory):
+    thread_index = utility.ThreadIndex(channel)
+    associated = 0
+    for thread in channel.thread_list:
+        message = channel.message(channel.index_of(thread.id))
+        if await utility.associate_thread(message, thread_index):
+            associated += 1
+    return associated
+
+
+async def stage_import(channel, args, directory):
+    backend = channel.backend
+    export = os.path.join(directory, f'{channel.id}.csv')
+    if not os.path.exists(export):
+        await checked_export(channel, export)
+        backend.stats.reset()
+    # the export stage already checked that the file holds one row per fetched message
+    fetched = count_rows(export)
+    job = jobs.Job('bench', 'import', 0, channel.id, 0, graceful=True)
+    with open(export, 'rb') as file:
+        imported = await utility.handle_messages(utility.open_rows(file), fake_discord.FakeInteraction(backend), channel, 'bench', fake_discord.FakeBot(), job, fake_discord.webhook_pool(backend, args.webhooks))
+    assert imported == fetched, f'{imported} rows imported for {fetched} fetched messages'
+    return imported
+
+
+async def run(count: int, args):
+    backend = fake_discord.FakeBackend(args.latency, args.rate_limit_ratio, args.retry_after, args.seed)
+    server = await fake_discord.AttachmentServer(backend).start()
+    # the real budget spaces sends 25ms apart, which would measure the budget instead of the pipeline
+    webhooks.global_budget = webhooks.RequestBudget(args.global_rate)
+    channel = fake_discord.FakeChannel(backend, count, server.url, args.seed)
+    previous_directory = os.getcwd()
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            # the import journal is written to the working directory
+            os.chdir(directory)
+            for stage in args.stages:
+                backend.stats.reset()
+                tracemalloc.start()
+                start = time.perf_counter()
+                processed = await globals()[f'stage_{stage}'](channel, args, directory)
+                elapsed = time.perf_counter() - start
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                print(f'{count:>10} {stage:>10} {processed:>10} {elapsed:>9.2f} {processed / elapsed:>10.0f} {peak / 1e6:>9.1f} '
+                      f'{backend.stats.total:>9} {backend.stats.rate_limited:>6}  {backend.stats}')
+    finally:
+        os.chdir(previous_directory)
+        await utility.close_http_session()
+        await server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline export/import throughput benchmark.')
+    parser.add_argument('sizes', nargs='*', type=int, default=DEFAULT_SIZES, help='Channel sizes in messages.')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES))
+    parser.add_argument('--latency', type=float, default=0.001, help='Seconds every API call takes.')
+    parser.add_argument('--rate-limit-ratio', type=float, default=0.01, help='Share of API calls answered with a 429.')
+    parser.add_argument('--retry-after', type=float, default=0.05, help='Retry-After of the simulated 429s.')
+    parser.add_argument('--global-rate', type=float, default=1e9, help='Global webhook requests per second.')
+    parser.add_argument('--slices', type=int, default=1, help='History slices of the export stage.')
+    parser.add_argument('--webhooks', type=int, default=webhooks.WEBHOOK_POOL_SIZE, help='Webhooks in the import pool.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--metrics', action='store_true', help='Print the per-stage metrics summary at the end.')
+    args = parser.parse_args()
+    print(f'{"messages":>10} {"stage":>10} {"processed":>10} {"seconds":>9} {"per sec":>10} {"peak MB":>9} {"API calls":>9} {"429s":>6}  breakdown')
+    for count in args.sizes:
+        asyncio.run(run(count, args))
+    if args.metrics:
+        print(metrics.summary())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""
+Benchmarks write_messages_csv on synthetic reply-heavy channels.
+Run from the repository root: python -m benchmarks.bench_reply_index [sizes...]
+"""
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+import discord
+
+from util import utility
+
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000]
+REPLY_RATIO = 0.5
+
+
+def synthetic_messages(count: int, seed: int = 0):
+    """
+    Generates a synthetic channel, oldest first, where roughly half of the messages are replies.
+    :param count: Number of messages to generate.
+    :param seed: Random seed.
+    :return: Generator of message-like objects.
+    """
+    rng = random.Random(seed)
+    authors = [SimpleNamespace(name=f'user{i}', display_avatar=SimpleNamespace(url=f'https://cdn.example/avatars/{i}.png')) for i in range(50)]
+    for message_id in range(1, count + 1):
+        reference = None
+        message_type = discord.MessageType.default
+        if message_id > 1 and rng.random() < REPLY_RATIO:
+            message_type = discord.MessageType.reply
+            reference = SimpleNamespace(message_id=rng.randint(1, message_id - 1))
+        yield SimpleNamespace(id=message_id, type=message_type, author=rng.choice(authors), content=f'message {message_id}',
+                              embeds=[], reactions=[], attachments=[], stickers=[], components=[], reference=reference,
+                              pinned=False, interaction=None)
+
+
+async def bench(count: int, file_name: str) -> float:
+    start = time.perf_counter()
+    await utility.write_messages_csv(synthetic_messages(count), file_name)
+    return time.perf_counter() - start
+
+
+def main(sizes):
+    with tempfile.TemporaryDirectory() as directory:
+        file_name = os.path.join(directory, 'bench.csv')
+        print(f'{"messages":>10} {"seconds":>10} {"msg/s":>12} {"us/msg":>8}')
+        for count in sizes:
+            elapsed = asyncio.run(bench(count, file_name))
+            print(f'{count:>10} {elapsed:>10.2f} {count / elapsed:>12.0f} {elapsed / count * 1e6:>8.2f}')
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES)
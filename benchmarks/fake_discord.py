@@ -0,0 +1,293 @@
+"""
+Local fake of the Discord channel, thread, webhook and history APIs used by the export and import pipeline.
+Every API call sleeps for a simulated latency and may be answered with a simulated 429, and a local aiohttp server
+serves the attachments, so benchmarks exercise the real code paths without a live guild.
+"""
+import asyncio
+import collections
+import datetime
+import itertools
+import random
+import time
+from types import SimpleNamespace
+
+import discord
+from aiohttp import web
+
+from util import webhooks
+
+HISTORY_PAGE = 100
+ARCHIVED_THREADS_PAGE = 50
+# one message per second keeps the ids valid snowflakes that map back to a message index
+MESSAGE_INTERVAL_MS = 1000
+CHANNEL_CREATED = datetime.datetime(2022, 1, 1, tzinfo=datetime.timezone.utc)
+ATTACHMENT_BYTES = 4096
+
+
+class ApiStats:
+    """
+    Counts the calls made to each fake endpoint and the 429s returned.
+    """
+    def __init__(self):
+        self.calls = collections.Counter()
+        self.rate_limited = 0
+
+    @property
+    def total(self) -> int:
+        return sum(self.calls.values())
+
+    def reset(self):
+        self.calls.clear()
+        self.rate_limited = 0
+
+    def __str__(self):
+        return ', '.join(f'{endpoint}={count}' for endpoint, count in sorted(self.calls.items()))
+
+
+class FakeBackend:
+    """
+    Shared latency and rate limit model of every fake endpoint.
+    """
+    def __init__(self, latency=0.001, rate_limit_ratio=0.0, retry_after=0.05, seed=0):
+        """
+        :param latency: Seconds every API call takes.
+        :param rate_limit_ratio: Share of calls answered with a 429 before succeeding on retry.
+        :param retry_after: Retry-After of the simulated 429s, in seconds.
+        :param seed: Random seed for the 429s.
+        """
+        self.latency = latency
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.stats = ApiStats()
+
+    async def call(self, endpoint: str, webhook_id: int = None):
+        """
+        Simulates one API request, retrying after the simulated 429s like discord.py does.
+        :param endpoint: Name the call is counted under.
+        :param webhook_id: Webhook the call is made through, its rate limit state is reported to webhooks.rate_limits.
+        :return: Void
+        """
+        while True:
+            self.stats.calls[endpoint] += 1
+            await asyncio.sleep(self.latency)
+            limited = self.rate_limit_ratio and self.rng.random() < self.rate_limit_ratio
+            if webhook_id is not None:
+                bucket = webhooks.rate_limits.stats_for(webhook_id)
+                bucket.requests += 1
+                webhooks.rate_limits.ready_at[webhook_id] = time.monotonic() + (self.retry_after if limited else 0)
+                if limited:
+                    bucket.rate_limited += 1
+            if not limited:
+                return
+            self.stats.rate_limited += 1
+            await asyncio.sleep(self.retry_after)
+
+
+class FakeMessage:
+    """
+    Message posted to the fake backend during an import.
+    """
+    def __init__(self, backend: FakeBackend, message_id: int):
+        self.backend = backend
+        self.id = message_id
+
+    async def pin(self):
+        await self.backend.call('pin')
+
+    async def reply(self, **kwargs):
+        for file in kwargs.get('files') or []:
+            file.close()
+        await self.backend.call('reply')
+        return FakeMessage(self.backend, next(_posted_ids))
+
+    async def delete(self):
+        await self.backend.call('delete_message')
+
+
+_posted_ids = itertools.count(1)
+
+
+class FakeWebhook:
+    def __init__(self, backend: FakeBackend, webhook_id: int):
+        self.backend = backend
+        self.id = webhook_id
+
+    async def send(self, wait=False, **kwargs):
+        for file in kwargs.get('files') or []:
+            file.close()
+        await self.backend.call('webhook_send', self.id)
+        return FakeMessage(self.backend, next(_posted_ids))
+
+
+class FakeChannel:
+    """
+    Synthetic text channel whose messages are generated on demand from their index, so even channels of a million
+    messages never live in memory at once.
+    """
+    def __init__(self, backend: FakeBackend, size: int, attachment_url: str = 'http://127.0.0.1:1', seed=0,
+                 reply_ratio=0.3, thread_ratio=0.01, attachment_ratio=0.05, component_ratio=0.02, reaction_ratio=0.1, pin_ratio=0.001):
+        """
+        :param backend: Backend the channel's API calls go through.
+        :param size: Number of messages in the channel.
+        :param attachment_url: Base url of the attachment server.
+        :param seed: Random seed, the same seed always yields the same channel.
+        """
+        self.backend = backend
+        self.size = size
+        self.seed = seed
+        self.attachment_url = attachment_url
+        self.ratios = (reply_ratio, thread_ratio, attachment_ratio, component_ratio, reaction_ratio, pin_ratio)
+        self.id = discord.utils.time_snowflake(CHANNEL_CREATED)
+        self.created_at = CHANNEL_CREATED
+        self.base_ms = (self.id >> 22) + MESSAGE_INTERVAL_MS
+        self.last_message_id = self.message_id(size - 1) if size else None
+        self.last_message = FakeMessage(backend, 0)
+        self.authors = [SimpleNamespace(name=f'user{i}', display_avatar=SimpleNamespace(url=f'https://cdn.example/avatars/{i}.png')) for i in range(50)]
+        self.thread_list = []
+        for index in range(size):
+            if self._kind(index) == 'thread':
+                self.thread_list.append(SimpleNamespace(id=self.message_id(index), name=f'thread {index}', created_at=discord.utils.snowflake_time(self.message_id(index)), jump_url=f'https://discord.com/channels/0/{self.message_id(index)}'))
+        # half of the threads are still active, the rest have to be listed through the archive endpoint
+        self.threads = self.thread_list[::2]
+        self.archived = self.thread_list[1::2]
+
+    def message_id(self, index: int) -> int:
+        return (self.base_ms + index * MESSAGE_INTERVAL_MS) << 22
+
+    def index_of(self, message_id: int) -> int:
+        """
+        Gets the index of the first message whose id is at least message_id.
+        """
+        return min(self.size, max(0, -(-(message_id - (self.base_ms << 22)) // (MESSAGE_INTERVAL_MS << 22))))
+
+    def _kind(self, index: int) -> str:
+        roll = random.Random(self.seed * 1_000_003 + index).random()
+        reply_ratio, thread_ratio = self.ratios[:2]
+        if index and roll < reply_ratio:
+            return 'reply'
+        if roll > 1 - thread_ratio:
+            return 'thread'
+        return 'default'
+
+    def message(self, index: int):
+        """
+        Builds the message at an index.
+        :param index: Index of the message, 0 being the oldest.
+        :return: Message-like object with every attribute the export reads.
+        """
+        rng = random.Random(self.seed * 1_000_003 + index)
+        rng.random()
+        _, _, attachment_ratio, component_ratio, reaction_ratio, pin_ratio = self.ratios
+        message_id = self.message_id(index)
+        kind = self._kind(index)
+        reference = None
+        message_type = discord.MessageType.default
+        if kind == 'reply':
+            message_type = discord.MessageType.reply
+            reference = SimpleNamespace(message_id=self.message_id(rng.randrange(index)))
+        elif kind == 'thread':
+            message_type = discord.MessageType.thread_created
+            # Discord points thread sysmessages at the thread's channel, without a message id
+            reference = SimpleNamespace(message_id=None, channel_id=message_id)
+        attachments = []
+        if rng.random() < attachment_ratio:
+            attachments = [SimpleNamespace(url=f'{self.attachment_url}/attachments/{message_id}/{i}/file{i}.png') for i in range(rng.randint(1, 3))]
+        components = []
+        if rng.random() < component_ratio:
+            button = SimpleNamespace(type=discord.ComponentType.button, style=discord.ButtonStyle.link, label='Open', emoji=None, custom_id=None, url='https://example.com', disabled=False)
+            components = [SimpleNamespace(type=discord.ComponentType.action_row, children=[button])]
+        reactions = []
+        if rng.random() < reaction_ratio:
+            reactions = [SimpleNamespace(emoji='👍', count=rng.randint(1, 20))]
+        return SimpleNamespace(id=message_id, type=message_type, author=rng.choice(self.authors), content=f'message {index}',
+                               embeds=[], reactions=reactions, attachments=attachments, stickers=[], components=components,
+                               reference=reference, pinned=rng.random() < pin_ratio, interaction=None, channel=self,
+                               created_at=discord.utils.snowflake_time(message_id), flags=SimpleNamespace(value=0))
+
+    async def history(self, limit=None, after=None, before=None, oldest_first=None):
+        """
+        Paginates the channel like discord.abc.Messageable.history, one API call per HISTORY_PAGE messages.
+        """
+        low = self.index_of(after.id + 1) if after is not None else 0
+        high = self.index_of(before.id) if before is not None else self.size
+        if oldest_first is None:
+            oldest_first = after is not None
+        indexes = range(low, high) if oldest_first else range(high - 1, low - 1, -1)
+        if limit is not None:
+            indexes = indexes[:limit]
+        for page in range(0, len(indexes), HISTORY_PAGE):
+            await self.backend.call('history')
+            for index in indexes[page:page + HISTORY_PAGE]:
+                yield self.message(index)
+
+    async def archived_threads(self, private=False, limit=None):
+        if private:
+            await self.backend.call('archived_threads')
+            return
+        for page in range(0, max(1, len(self.archived)), ARCHIVED_THREADS_PAGE):
+            await self.backend.call('archived_threads')
+            for thread in self.archived[page:page + ARCHIVED_THREADS_PAGE]:
+                yield thread
+
+    async def create_thread(self, name, **kwargs):
+        await self.backend.call('create_thread')
+        return SimpleNamespace(id=next(_posted_ids), name=name, jump_url='https://discord.com/channels/0/0')
+
+    def get_partial_message(self, message_id: int) -> FakeMessage:
+        return FakeMessage(self.backend, message_id)
+
+
+class FakeBot:
+    """
+    Client the import looks the guild's boost tier up on.
+    """
+    def __init__(self, premium_tier=0):
+        self.guild = SimpleNamespace(id=0, premium_tier=premium_tier)
+
+    def get_guild(self, guild_id):
+        return self.guild
+
+
+class FakeInteraction:
+    def __init__(self, backend: FakeBackend):
+        self.guild_id = 0
+        self.channel_id = 0
+        self.user = SimpleNamespace(id=0, send=self._send)
+        self.backend = backend
+
+    async def _send(self, *args, **kwargs):
+        await self.backend.call('dm')
+
+
+def webhook_pool(backend: FakeBackend, size=webhooks.WEBHOOK_POOL_SIZE) -> webhooks.WebhookPool:
+    return webhooks.WebhookPool([FakeWebhook(backend, webhook_id) for webhook_id in range(1, size + 1)], [])
+
+
+class AttachmentServer:
+    """
+    Local HTTP server answering every attachment url with ATTACHMENT_BYTES bytes after the backend's latency.
+    """
+    def __init__(self, backend: FakeBackend, size=ATTACHMENT_BYTES):
+        self.backend = backend
+        self.body = b'\0' * size
+        self.runner = None
+        self.url = None
+
+    async def _handle(self, request):
+        await self.backend.call('cdn')
+        return web.Response(body=self.body, content_type='image/png')
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/{tail:.*}', self._handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f'http://127.0.0.1:{port}'
+        return self
+
+    async def stop(self):
+        await self.runner.cleanup()
@@ -14,12 +14,33 @@ class Message:
         return embed
     
     @staticmethod
-    def emoji_display(emojis):
+    def orphaned_reply():
+        embed = discord.Embed(color=discord.Color.from_rgb(3, 191, 153))
+        embed.description = 'This message replied to a message that is not part of this archive.'
+        return embed
+
+    @staticmethod
+    def unrepliable_reply(author_name, avatar_url, content: str):
+        embed = discord.Embed(color=discord.Color.from_rgb(3, 191, 153))
+        embed.set_author(name=author_name, icon_url=avatar_url)
+        embed.description = content
+        embed.set_footer(text='This message replied to the above message from this archive, which could not be replied to.')
+        return embed
+
+    @staticmethod
+    def emoji_display(emojis, attached=False):
         embed = discord.Embed(color=discord.Color.from_rgb(3, 191, 153))
         embed.description = '|'
         for emoji, count in emojis:
             embed.description += f' {discord.PartialEmoji.from_str(emoji)}: `{count}` |'
-        embed.set_footer(text='The above message had these reactions.')
+        embed.set_footer(text='This message had these reactions.' if attached else 'The above message had these reactions.')
+        return embed
+
+    @staticmethod
+    def large_files(urls):
+        embed = discord.Embed(color=discord.Color.from_rgb(3, 191, 153))
+        embed.description = '\n'.join(urls)
+        embed.set_footer(text='These attachments were too large to upload.')
         return embed
 
 class Thread:
@@ -3,9 +3,27 @@ class DuplicateThreadException(Exception):
     def __init__(self, count: int, message: discord.Message):
         self.count = count
         self.message = message
-        super().__init__(self.table, self.channel, self.guild)
+        super().__init__(count, message)
 
     def __str__(self):
         return f"{type(self).__name__} -- found {self.count} possible threads for message {self.message.id} in channel {self.message.channel.id} in guild {self.message.guild.id} - Should be at most 1."
 
-    pass
\ No newline at end of file
+    pass
+
+class ImportStoppedException(Exception):
+    def __init__(self, channel_name, rownum: int, cause: Exception):
+        self.channel_name = channel_name
+        self.rownum = rownum
+        self.cause = cause
+        super().__init__(channel_name, rownum, cause)
+
+    def __str__(self):
+        return f"{type(self).__name__} -- import of {self.channel_name} stopped at row {self.rownum}: {self.cause}"
+
+class ImportSourceChangedException(Exception):
+    def __init__(self, journal: str):
+        self.journal = journal
+        super().__init__(journal)
+
+    def __str__(self):
+        return f"{type(self).__name__} -- {self.journal} was written for a different version of this export. Run the import again with restart to start over, messages that were already imported will be posted again."
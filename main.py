@@ -1,11 +1,5 @@
-import csv
 import os
-import discord
-from util import log_helper, utility
-from discord import app_commands as ap
-from data import embeds as em
-import datetime
-import atexit
+from util import log_helper
 
 token = os.getenv('ZERABOT_TOKEN')
 
@@ -13,27 +7,96 @@ logger = log_helper.get_logger(__name__)
 if token is None:
     logger.error('Token not found. Please set the ZERABOT_TOKEN environment variable.')
     exit(1)
-bot = discord.Client(intents=discord.Intents.all())
+
+# the discord stack is only imported once the config is known to be usable
+import asyncio
+import csv
+import discord
+from util import utility, users, codec, archive, jobs, webhooks, metrics, gateway
+from discord import app_commands as ap
+from data import embeds as em
+import datetime
+
+class ZeraBot(discord.Client):
+    async def setup_hook(self):
+        # runs once per login, unlike on_ready which fires again after every gateway reconnect
+        await utility.load_command_groups(self, __name__)
+        await utility.sync_command_tree(self)
+
+    async def close(self):
+        await utility.close_http_session()
+        await metrics.stop_server()
+        await super().close()
+
+bot = ZeraBot(**gateway.client_options())
 bot.tree = ap.CommandTree(bot)
+user_resolver = users.UserResolver(bot)
+
+async def update_presence(manager: jobs.JobManager):
+    running = manager.running
+    await bot.change_presence(activity=discord.CustomActivity(name=f'Running {running} archive job{"s" if running > 1 else ""}...' if running else 'Standby'))
+
+job_manager = jobs.JobManager(on_change=update_presence)
+
+async def start_job(interaction: discord.Interaction, kind: str, run, message: str, channel_id: int = None, graceful=False):
+    """
+    Queues a job and tells the user its id, or why it could not be started.
+    :param interaction: Interaction that started the job.
+    :param kind: Short description of the job.
+    :param run: Coroutine function taking the Job.
+    :param message: Message to acknowledge the interaction with.
+    :param channel_id: Channel the job works on, defaults to the interaction's channel.
+    :param graceful: Whether the job checks job.cancelled itself.
+    :return: Void
+    """
+    async def run_and_report(job):
+        try:
+            await run(job)
+        except Exception as e:
+            # the job manager only logs failures, the user would otherwise be left with the acknowledgement
+            try:
+                await interaction.user.send(f'Job {job.id} ({kind}) failed: {e}')
+            except discord.HTTPException as dm_error:
+                logger.warning('Could not tell %s that job %s failed: %s', interaction.user.id, job.id, dm_error)
+            raise
+
+    try:
+        job = job_manager.submit(kind, interaction, run_and_report, channel_id, graceful)
+    except jobs.JobConflictException as e:
+        await interaction.response.send_message(f'Job {e.job.id} ({e.job.kind}) is already running in this channel.', ephemeral=True)
+        return
+    await interaction.response.send_message(f'{message} (job `{job.id}`)', ephemeral=True)
 
-should_stop = False
-rows = []
-last_import = 0
-last_export = 0
+FORUM_EXPORT_CONCURRENCY = int(os.getenv('ZERABOT_FORUM_EXPORT_CONCURRENCY', 4))
+FORUM_IMPORT_CONCURRENCY = int(os.getenv('ZERABOT_FORUM_IMPORT_CONCURRENCY', 3))
 
 @bot.event
 async def on_ready():
-    await utility.load_command_groups(bot, __name__)
-    syncs = await bot.tree.sync()
-    logger.debug(f'Syncs: {len(syncs)}')
-    print(f'{bot.user} has connected to Discord!')
-    await bot.change_presence(activity=discord.CustomActivity(name='Standby'))
+    # also fires after reconnects, so everything here has to be safe to run again
+    logger.info('%s has connected to Discord!', bot.user)
+    await update_presence(job_manager)
+    await metrics.start_server()
 
 @ap.default_permissions()
 class ArchiveToolsGroup(ap.Group):
     def __init__(self):
         super().__init__(name='archivetools', description='Tools for archiving messages.')
 
+    @ap.command(name='jobs', description='List the archive jobs running in this server.')
+    @ap.default_permissions()
+    async def list_jobs(self, interaction: discord.Interaction):
+        active = job_manager.active(interaction.guild_id)
+        await interaction.response.send_message('\n'.join(str(job) for job in active) if active else 'No jobs are running.', ephemeral=True)
+
+    @ap.command(name='stats', description='Show where export and import time has gone since the bot started.')
+    @ap.default_permissions()
+    async def stats(self, interaction: discord.Interaction):
+        await interaction.response.send_message(f'```\n{metrics.summary()[:1900]}\n```', ephemeral=True)
+
+
+def export_name(channel_id, compressed: bool) -> str:
+    return f'{channel_id}{archive.ARCHIVE_EXTENSION if compressed else ".csv"}'
+
 
 class ExportToolsGroup(ap.Group):
     def __init__(self):
@@ -41,69 +104,96 @@ class ExportToolsGroup(ap.Group):
 
     @ap.command(name='bot', description='Export messages to a csv *that is stored by the bot*.')
     @ap.default_permissions()
-    async def csv_out(self, interaction: discord.Interaction):
-        await interaction.response.send_message('Started fetching messages. You will receive a dm upon completion.', ephemeral=True)
-        await bot.change_presence(activity=discord.CustomActivity(name='Exporting messages...'))
-        start_time = datetime.datetime.now()
-        messages, total_messages, actually_fetched = await utility.fetch_messages(interaction.channel)
-        await utility.write_messages_csv(messages, f'{interaction.channel_id}.csv')
-        end_time = datetime.datetime.now()
-        total_time = end_time - start_time
-        await interaction.user.send(
-            f'Fetched and exported {actually_fetched} messages out of {total_messages} in {total_time.total_seconds()} seconds.')
-        await bot.change_presence(activity=discord.CustomActivity(name='Standby'))
+    @ap.describe(compressed='Write a compressed archive instead of a csv.', slices='Split the history into this many time slices fetched in parallel.',
+                 incremental='Only fetch messages newer than the last export of this channel and append them (csv only).',
+                 resync_hours='With incremental, also refetch the last this many hours to pick up edits and reactions.')
+    async def csv_out(self, interaction: discord.Interaction, compressed: bool = False, slices: ap.Range[int, 1, 32] = 1, incremental: bool = False, resync_hours: ap.Range[int, 0, 720] = 0):
+        async def run(job):
+            start_time = datetime.datetime.now()
+            _, total_messages, actually_fetched = await utility.export_messages(interaction.channel, export_name(interaction.channel_id, compressed), slices,
+                                                                                 incremental, datetime.timedelta(hours=resync_hours) if resync_hours else None)
+            end_time = datetime.datetime.now()
+            total_time = end_time - start_time
+            await interaction.user.send(
+                f'Fetched and exported {actually_fetched} messages out of {total_messages} in {total_time.total_seconds()} seconds.')
+
+        await start_job(interaction, 'export', run, 'Started fetching messages. You will receive a dm upon completion.')
     
     @ap.command(name='user', description='Export messages to a csv *that is sent to you*.')
     @ap.default_permissions()
-    async def csv_out_user(self, interaction: discord.Interaction):
-        await interaction.response.send_message('Started fetching messages. You will receive a dm upon completion containing the output file. If the file is too large to be sent over discord, it will fallback to storing the file in the bot.', ephemeral=True)
-        await bot.change_presence(activity=discord.CustomActivity(name='Exporting messages...'))
-        start_time = datetime.datetime.now()
-        messages, total_messages, actually_fetched = await utility.fetch_messages(interaction.channel)
-        file = await utility.write_messages_csv(messages, f'{interaction.channel_id}.csv')
-        end_time = datetime.datetime.now()
-        total_time = end_time - start_time
-        await interaction.user.send(
-            f'Fetched and exported {actually_fetched} messages out of {total_messages} in {total_time.total_seconds()} seconds.', file=file)
-        await bot.change_presence(activity=discord.CustomActivity(name='Standby'))
+    @ap.describe(compressed='Send a compressed archive instead of a csv.', slices='Split the history into this many time slices fetched in parallel.')
+    async def csv_out_user(self, interaction: discord.Interaction, compressed: bool = False, slices: ap.Range[int, 1, 32] = 1):
+        async def run(job):
+            start_time = datetime.datetime.now()
+            file, total_messages, actually_fetched = await utility.export_messages(interaction.channel, export_name(interaction.channel_id, compressed), slices)
+            end_time = datetime.datetime.now()
+            total_time = end_time - start_time
+            try:
+                await interaction.user.send(
+                    f'Fetched and exported {actually_fetched} messages out of {total_messages} in {total_time.total_seconds()} seconds.', file=file)
+            except discord.HTTPException as e:
+                logger.warning('Could not send export %s: %s', file.filename, e)
+                await interaction.user.send(
+                    f'Fetched and exported {actually_fetched} messages out of {total_messages} in {total_time.total_seconds()} seconds. The file was too large to send and is stored by the bot.')
+
+        await start_job(interaction, 'export', run, 'Started fetching messages. You will receive a dm upon completion containing the output file. If the file is too large to be sent over discord, it will fallback to storing the file in the bot.')
+
+    @ap.command(name='count', description='Count the messages in this channel without exporting them.')
+    @ap.default_permissions()
+    async def count(self, interaction: discord.Interaction):
+        async def run(job):
+            message_count, time_taken = await utility.get_message_count(interaction.channel)
+            await interaction.user.send(f'Counted {message_count} messages in {time_taken} seconds.')
+
+        await start_job(interaction, 'count', run, 'Started counting messages. You will receive a dm upon completion.')
 
     @ap.command(name='forum', description='Export a forum channel and all of it\'s threads. Due to complexity, no user option is available.')
     @ap.default_permissions()
-    async def forum_out(self, interaction: discord.Interaction, channel: discord.ForumChannel):
-        await interaction.response.send_message('Started fetching messages. You will receive a dm upon completion.', ephemeral=True)
-        await bot.change_presence(activity=discord.CustomActivity(name='Exporting forum...'))
-        start_time = datetime.datetime.now()
-        total_total_messages = 0
-        total_total_fetched = 0
-        with open(f'{channel.id}_forum_data.csv', 'w', newline='', encoding='utf-8') as file:
-            writer = csv.writer(file)
-            encoded_tags = [await utility.forum_tag_to_dict(tag, interaction.guild) for tag in channel.available_tags]
-            writer.writerow([channel.name, encoded_tags, channel.default_reaction_emoji if type(channel.default_reaction_emoji) == str or not channel.default_reaction_emoji else await interaction.guild.fetch_emoji(channel.default_reaction_emoji.id), channel.topic])
-            total_exp_threads = 0
-            total_threads = 0
-            for thread in channel.threads:
-                total_exp_threads += 1
-                owner = await bot.fetch_user(thread.owner_id)
-                encoded_applied_tag_names = [tag.name for tag in thread.applied_tags]
-                writer.writerow([thread.id, thread.name, 1 if thread.locked else 0, owner.name if owner else 'Unknown', encoded_applied_tag_names])
-                messages, total_messages, actually_fetched = await utility.fetch_messages(thread)
-                total_total_messages += total_messages
-                total_total_fetched += actually_fetched
-                await utility.write_messages_csv(messages, f'{thread.id}.csv')
+    @ap.describe(compressed='Write compressed archives instead of csvs for the threads.')
+    async def forum_out(self, interaction: discord.Interaction, channel: discord.ForumChannel, compressed: bool = False):
+        async def run(job):
+            start_time = datetime.datetime.now()
+            total_total_messages = 0
+            total_total_fetched = 0
+            threads = list(channel.threads)
             async for thread in channel.archived_threads(limit=None):
-                total_exp_threads += 1
-                owner = await bot.fetch_user(thread.owner_id)
-                encoded_applied_tag_names = [tag.name for tag in thread.applied_tags]
-                writer.writerow([thread.id, thread.name, 1 if thread.locked else 0, owner.name if owner else 'Unknown', encoded_applied_tag_names])
-                messages, total_messages, actually_fetched = await utility.fetch_messages(thread)
-                total_total_messages += total_messages
-                total_total_fetched += actually_fetched
-                await utility.write_messages_csv(messages, f'{thread.id}.csv')
+                threads.append(thread)
+            lookup_stats = users.LookupStats()
+            owners = await user_resolver.resolve_many([thread.owner_id for thread in threads], interaction.guild, lookup_stats)
+            logger.info('Owner lookups for forum %s: %s', channel.id, lookup_stats)
+            semaphore = asyncio.Semaphore(FORUM_EXPORT_CONCURRENCY)
 
-        end_time = datetime.datetime.now()
-        total_time = end_time - start_time
-        await interaction.user.send(f'Fetched and exported {total_exp_threads} threads from `{channel.name}` ({channel.id}) in {total_time.total_seconds()} seconds.\nTotal message count: {total_total_fetched}, Total fetched: {total_total_fetched}')
-        await bot.change_presence(activity=discord.CustomActivity(name='Standby'))
+            async def export_thread(thread):
+                async with semaphore:
+                    _, total_messages, actually_fetched = await utility.export_messages(thread, export_name(thread.id, compressed))
+                    return owners.get(thread.owner_id), total_messages, actually_fetched
+
+            results = await asyncio.gather(*[export_thread(thread) for thread in threads], return_exceptions=True)
+            failures = []
+            with open(f'{channel.id}_forum_data.csv', 'w', newline='', encoding='utf-8') as file:
+                writer = csv.writer(file)
+                emojis = utility.EmojiCache(interaction.guild)
+                encoded_tags = [await utility.forum_tag_to_dict(tag, emojis) for tag in channel.available_tags]
+                writer.writerow([channel.name, codec.encode_column(encoded_tags), channel.default_reaction_emoji if type(channel.default_reaction_emoji) == str or not channel.default_reaction_emoji else await emojis.get(channel.default_reaction_emoji.id), channel.topic])
+                total_exp_threads = 0
+                # atlas rows follow the listing order (active threads, then archived) regardless of which export finished first
+                for thread, result in zip(threads, results):
+                    if isinstance(result, Exception):
+                        logger.error('Failed to export thread %s: %s', thread.id, result)
+                        failures.append(f'`{thread.name}` ({thread.id}): {result}')
+                        continue
+                    owner, total_messages, actually_fetched = result
+                    total_exp_threads += 1
+                    encoded_applied_tag_names = [tag.name for tag in thread.applied_tags]
+                    writer.writerow([thread.id, thread.name, 1 if thread.locked else 0, owner.name if owner else 'Unknown', codec.encode_column(encoded_applied_tag_names)])
+                    total_total_messages += total_messages
+                    total_total_fetched += actually_fetched
+
+            end_time = datetime.datetime.now()
+            total_time = end_time - start_time
+            await interaction.user.send(f'Fetched and exported {total_exp_threads} threads from `{channel.name}` ({channel.id}) in {total_time.total_seconds()} seconds.\nTotal message count: {total_total_fetched}, Total fetched: {total_total_fetched}' + (f'\nFailed to export {len(failures)} threads:\n' + '\n'.join(failures[:20]) if failures else ''))
+
+        await start_job(interaction, 'forum export', run, 'Started fetching messages. You will receive a dm upon completion.', channel.id)
 
 
 
@@ -113,54 +203,37 @@ class ImportToolsGroup(ap.Group):
 
     @ap.command(name='bot', description='Import messages from a csv *that was stored by the bot*.')
     @ap.default_permissions()
-    async def csv_in(self, interaction: discord.Interaction, channel_id: str):
-        global rows
-        global should_stop
-        global last_import
-
+    @ap.describe(restart='Start over instead of resuming an import of this export that stopped.')
+    async def csv_in(self, interaction: discord.Interaction, channel_id: str, restart: bool = False):
         if not channel_id.isnumeric():
             await interaction.response.send_message('Invalid channel id. (must be number)', ephemeral=True)
             return
-        if os.path.exists('badexit.csv'):
-            await interaction.response.send_message('There is an unresolved badexit.csv file. Please resolve it before continuing.', ephemeral=True)
-            return
 
         channel_id = int(channel_id)
-        filename = f'{channel_id}.csv' if not os.path.exists(f'{channel_id}_in_progress.csv') else f'{channel_id}_in_progress.csv'
-        await interaction.response.send_message('Importing messages from csv.', ephemeral=True)
-        
-        await bot.change_presence(activity=discord.CustomActivity(name='Importing messages...'))
-        with open(filename, 'r', newline='', encoding='utf-8') as file:
-            reader = csv.reader(file)
-            await utility.handle_messages(reader, interaction, interaction.channel, channel_id, bot, rows, last_import)
-        await bot.change_presence(activity=discord.CustomActivity(name='Standby'))
+        filename = utility.export_path(channel_id)
+
+        async def run(job):
+            with open(filename, 'rb') as file:
+                await utility.handle_messages(utility.open_rows(file), interaction, interaction.channel, channel_id, bot, job, restart=restart)
+
+        await start_job(interaction, 'import', run, 'Importing messages from csv.', graceful=True)
     
     @ap.command(name='user', description='Import messages from a csv *that is provided by you*.')
     @ap.default_permissions()
-    async def csv_in_user(self, interaction: discord.Interaction, csv_file: discord.Attachment):
-        global rows
-        global should_stop
-        global last_import
-        if os.path.exists('badexit.csv'):
-            await interaction.response.send_message('There is an unresolved badexit.csv file. Please resolve it before continuing.', ephemeral=True)
-            return
+    @ap.describe(restart='Start over instead of resuming an import of this file that stopped.')
+    async def csv_in_user(self, interaction: discord.Interaction, csv_file: discord.Attachment, restart: bool = False):
+        async def run(job):
+            file_name = csv_file.filename
+            # the upload is streamed into a spooled temp file so it is never decoded into memory as a whole
+            file, _ = await utility.read_attachment_url(csv_file.url)
+            with file:
+                await utility.handle_messages(utility.open_rows(file), interaction, interaction.channel, file_name, bot, job, restart=restart)
 
-        await interaction.response.send_message('Importing messages from csv.', ephemeral=True)
-        await bot.change_presence(activity=discord.CustomActivity(name='Importing messages...'))
-        file_byes = await csv_file.read()
-        file_name = csv_file.filename
-        file = file_byes.decode('utf-8')
-        reader = csv.reader(iter(file.splitlines()))
-        await utility.handle_messages(reader, interaction, interaction.channel, file_name, bot, rows, last_import)
-        await bot.change_presence(activity=discord.CustomActivity(name='Standby'))
+        await start_job(interaction, 'import', run, 'Importing messages from csv.', graceful=True)
 
     @ap.command(name='forum', description='Import a forum channel and all of it\'s threads. Due to complexity, no user option is available.')
     @ap.default_permissions()
     async def forum_in(self, interaction, channel_id: str):
-        global rows
-        global should_stop
-        global last_import
-
         if not channel_id.isnumeric():
             await interaction.response.send_message('Invalid channel id. (must be number)', ephemeral=True)
             return
@@ -168,52 +241,70 @@ class ImportToolsGroup(ap.Group):
             await interaction.response.send_message('Forum thread atlas not found.', ephemeral=True)
             return
 
-        await interaction.response.send_message('Importing forum from csv.', ephemeral=True)
-        await bot.change_presence(activity=discord.CustomActivity(name='Importing forum...'))
-        start_time = datetime.datetime.now()
-        with open(f'{channel_id}_forum_data.csv', 'r', newline='', encoding='utf-8') as file:
-            reader = csv.reader(file)
-            forum_name, tags_unparsed, default_reaction_emoji, topic = next(reader)
+        async def run(job):
+            start_time = datetime.datetime.now()
+            with open(f'{channel_id}_forum_data.csv', 'r', newline='', encoding='utf-8') as file:
+                reader = csv.reader(file)
+                forum_name, tags_unparsed, default_reaction_emoji, topic = next(reader)
+                rows = list(reader)
             # overriding the default_reaction_emoji param with a placeholder emoji
-            forum_channel = await interaction.guild.create_forum(name=forum_name, topic=topic, default_reaction_emoji="🔥", available_tags=[utility.dict_to_forum_tag(tag) for tag in eval(tags_unparsed)], category=interaction.channel.category, reason='Importing forum')
-            for row in reader:
-                thread_id = int(row[0])
-                thread_name = row[1]
-                locked = bool(row[2])
-                owner = row[3]
-                available_tags_indxs = {tag.name: i for i, tag in enumerate(forum_channel.available_tags)}
-                print(available_tags_indxs)
-                applied_tags = [forum_channel.available_tags[available_tags_indxs[tag]] for tag in eval(row[4])]
-                threadwithmessage = await forum_channel.create_thread(name=thread_name, embed=em.Thread.thread_import_init_message(owner, thread_name), applied_tags=applied_tags, reason='Importing thread')
-                thread = threadwithmessage[0]
-                await utility.handle_messages(csv.reader(open(f'{thread_id}.csv', 'r', newline='', encoding='utf-8')), interaction, thread, thread_id, bot, rows, last_import)
-                    
-        await interaction.user.send(f'Imported forum from `{forum_name}` ({channel_id}) in {datetime.datetime.now() - start_time}.')
-        await bot.change_presence(activity=discord.CustomActivity(name='Standby'))
+            forum_channel = await interaction.guild.create_forum(name=forum_name, topic=topic, default_reaction_emoji="🔥", available_tags=[utility.dict_to_forum_tag(tag) for tag in codec.decode_any(tags_unparsed)], category=interaction.channel.category, reason='Importing forum')
+            tags_by_name = {tag.name: tag for tag in forum_channel.available_tags}
+            # every thread posts through the forum's webhooks, so one pool serves all of them
+            webhook = await webhooks.WebhookPool.create(forum_channel, utility.get_http_session(), bot)
+            semaphore = asyncio.Semaphore(FORUM_IMPORT_CONCURRENCY)
+
+            async def import_thread(row):
+                async with semaphore:
+                    if job.cancelled:
+                        return 0
+                    thread_id = int(row[0])
+                    thread_name = row[1]
+                    locked = bool(row[2])
+                    owner = row[3]
+                    applied_tags = [tags_by_name[tag] for tag in codec.decode_any(row[4])]
+                    await webhooks.global_budget.acquire()
+                    threadwithmessage = await forum_channel.create_thread(name=thread_name, embed=em.Thread.thread_import_init_message(owner, thread_name), applied_tags=applied_tags, reason='Importing thread')
+                    thread = threadwithmessage[0]
+                    with open(utility.export_path(thread_id), 'rb') as thread_file:
+                        # every run creates a new forum, so a thread that stops cannot be resumed into
+                        return await utility.handle_messages(utility.open_rows(thread_file), interaction, thread, thread_id, bot, job, webhook, resumable=False)
+
+            try:
+                results = await asyncio.gather(*[import_thread(row) for row in rows], return_exceptions=True)
+            finally:
+                await webhook.delete()
+            failures = []
+            total_imported = 0
+            for row, result in zip(rows, results):
+                if isinstance(result, Exception):
+                    logger.error('Failed to import thread %s: %s', row[0], result)
+                    failures.append(f'`{row[1]}` ({row[0]}): {result}')
+                else:
+                    total_imported += result
+            report = webhook.report()
+            logger.info(report)
+            await interaction.user.send(f'Imported {len(rows) - len(failures)} threads with {total_imported} messages from `{forum_name}` ({channel_id}) in {datetime.datetime.now() - start_time}{" (cancelled)" if job.cancelled else ""}.\n{report}' + (f'\nFailed to import {len(failures)} threads:\n' + '\n'.join(failures[:20]) if failures else ''))
+
+        await start_job(interaction, 'forum import', run, 'Importing forum from csv.', graceful=True)
     
-    @ap.command(name='cancel', description='Cancel the current import process.')
+    @ap.command(name='cancel', description='Cancel a running job, by default every job in this channel.')
     @ap.default_permissions()
-    async def cancel(self, interaction: discord.Interaction):
-        utility.should_stop = True
-        await interaction.response.send_message('Cancel flag set.', ephemeral=True)
-
-def on_stop():
-    global rows
-    global last_import
-    global last_export
-    if rows:
-        rows = rows[last_import:]
-        with open(f'badexit.csv', 'w', newline='', encoding='utf-8') as file:
-                writer = csv.writer(file)
-                for row in rows:
-                    writer.writerow(row)
-        logger.error('Unexpected exit. Wrote to badexit.csv.')
-
-atexit.register(on_stop)
+    @ap.describe(job_id='Id of the job to cancel, as shown by /archivetools jobs.')
+    async def cancel(self, interaction: discord.Interaction, job_id: str = None):
+        if job_id:
+            targets = [job for job in job_manager.active(interaction.guild_id) if job.id == job_id]
+        else:
+            targets = [job for job in job_manager.active(interaction.guild_id) if job.channel_id == interaction.channel_id]
+        if not targets:
+            await interaction.response.send_message('No matching job is running.', ephemeral=True)
+            return
+        for job in targets:
+            job_manager.cancel(job)
+        await interaction.response.send_message(f'Cancel flag set for job {", ".join(job.id for job in targets)}.', ephemeral=True)
 
 try:
     bot.run(token)
 except Exception as e:
-    logger.critical(f'Unexpected exit: {e}')
-    on_stop()
+    logger.critical('Unexpected exit: %s', e)
     exit(1)
\ No newline at end of file
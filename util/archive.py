@@ -0,0 +1,177 @@
+import bisect
+import json
+import os
+import struct
+import zlib
+from util import codec
+
+# archive layout:
+#   MAGIC
+#   blocks: 4 byte big-endian length + zlib compressed JSON list of rows
+#   footer: zlib compressed JSON with the format version, the author dictionary and the block index (offset, row count and first and last message id of every block)
+#   8 byte big-endian footer offset + MAGIC
+# rows are the csv export rows with the author name and avatar url replaced by an index into the author dictionary
+MAGIC = b'ZARC\x01'
+ARCHIVE_EXTENSION = '.zarc'
+BLOCK_ROWS = 1000
+COMPRESSION_LEVEL = 6
+_TRAILER = struct.Struct('>Q')
+_LENGTH = struct.Struct('>I')
+# position of the message id in a stored row, whose author name and avatar url are folded into one index
+_ID_COLUMN = 3
+
+
+def is_archive(file) -> bool:
+    """
+    Checks whether a binary file is a compressed archive, leaving its position untouched.
+    :param file: Binary file object.
+    :return: Whether the file starts with the archive magic.
+    """
+    position = file.tell()
+    file.seek(0)
+    magic = file.read(len(MAGIC))
+    file.seek(position)
+    return magic == MAGIC
+
+
+class ArchiveWriter:
+    """
+    Streams export rows into a compressed archive, one block of BLOCK_ROWS rows at a time.
+    Has the same writerow/writerows interface as csv.writer.
+    """
+    def __init__(self, file_name: str, version=codec.EXPORT_VERSION):
+        self.file = open(file_name, 'wb')
+        self.file.write(MAGIC)
+        self.version = version
+        self.authors = {}
+        self.blocks = []
+        self.pending = []
+
+    def writerow(self, row):
+        if codec.read_version(row) is not None:
+            # the version lives in the footer
+            self.version = codec.read_version(row)
+            return
+        author = (row[0], row[1])
+        if author not in self.authors:
+            self.authors[author] = len(self.authors)
+        self.pending.append([self.authors[author], *row[2:]])
+        if len(self.pending) >= BLOCK_ROWS:
+            self._flush()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def _flush(self):
+        if not self.pending:
+            return
+        payload = zlib.compress(json.dumps(self.pending, ensure_ascii=False, separators=(',', ':')).encode('utf-8'), COMPRESSION_LEVEL)
+        ids = [int(row[_ID_COLUMN]) for row in self.pending]
+        self.blocks.append([self.file.tell(), len(self.pending), min(ids), max(ids)])
+        self.file.write(_LENGTH.pack(len(payload)))
+        self.file.write(payload)
+        self.pending = []
+
+    def close(self):
+        self._flush()
+        footer_offset = self.file.tell()
+        footer = {'version': self.version, 'authors': [list(author) for author in self.authors], 'blocks': self.blocks}
+        self.file.write(zlib.compress(json.dumps(footer, ensure_ascii=False, separators=(',', ':')).encode('utf-8'), COMPRESSION_LEVEL))
+        self.file.write(_TRAILER.pack(footer_offset))
+        self.file.write(MAGIC)
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ArchiveReader:
+    """
+    Streams rows out of a compressed archive with the same interface as utility.RowCursor.
+    Rows come out exactly as a csv reader would return them, and positions are row numbers instead of byte offsets.
+    """
+    def __init__(self, file, start=0):
+        """
+        :param file: Binary file object to read from.
+        :param start: Row to start reading at.
+        """
+        self.file = file
+        self.file.seek(-(_TRAILER.size + len(MAGIC)), os.SEEK_END)
+        footer_offset = _TRAILER.unpack(self.file.read(_TRAILER.size))[0]
+        self.file.seek(footer_offset)
+        footer = json.loads(zlib.decompress(self.file.read()).decode('utf-8'))
+        self.version = footer['version']
+        self.authors = footer['authors']
+        self.blocks = footer['blocks']
+        self.block_starts = []
+        total = 0
+        for block in self.blocks:
+            self.block_starts.append(total)
+            total += block[1]
+        self.total = total
+        self.rownum = start - 1
+        self.block = None
+        self.block_index = -1
+
+    def _load(self, block_index: int):
+        offset = self.blocks[block_index][0]
+        self.file.seek(offset)
+        length = _LENGTH.unpack(self.file.read(_LENGTH.size))[0]
+        self.block = json.loads(zlib.decompress(self.file.read(length)).decode('utf-8'))
+        self.block_index = block_index
+
+    def row(self, rownum: int) -> list:
+        """
+        Reads a single row.
+        :param rownum: Row number.
+        :return: Row as a list of strings.
+        """
+        block_index = bisect.bisect_right(self.block_starts, rownum) - 1
+        if block_index != self.block_index:
+            self._load(block_index)
+        author, *rest = self.block[rownum - self.block_starts[block_index]]
+        return [str(value) for value in (*self.authors[author], *rest)]
+
+    def find(self, message_id: int):
+        """
+        Finds the row of a message through the block id index, only decompressing the blocks whose id range holds it.
+        :param message_id: Id of the message.
+        :return: Row number, or None if the message is not in the archive.
+        """
+        for block_index, block in enumerate(self.blocks):
+            # archives written without the id index have offset and row count only
+            if len(block) < 4 or not block[2] <= message_id <= block[3]:
+                continue
+            if block_index != self.block_index:
+                self._load(block_index)
+            for i, row in enumerate(self.block):
+                if int(row[_ID_COLUMN]) == message_id:
+                    return self.block_starts[block_index] + i
+        return None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.rownum + 1 >= self.total:
+            raise StopIteration
+        self.rownum += 1
+        return self.rownum, self.row(self.rownum)
+
+    def offset_of(self, rownum: int) -> int:
+        return rownum
+
+    def seek(self, position: int):
+        """
+        Moves the reader to a position returned by offset_of.
+        :param position: Row number.
+        :return: Void
+        """
+        self.rownum = position - 1
+
+    def size(self) -> int:
+        return self.file.seek(0, os.SEEK_END)
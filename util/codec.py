@@ -0,0 +1,63 @@
+import ast
+import json
+
+# exports start with a marker row carrying the format version, files without one are legacy (version 1) exports
+EXPORT_MARKER = '__zerabot_export__'
+EXPORT_VERSION = 2
+LEGACY_VERSION = 1
+
+_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+_decode = json.JSONDecoder().decode
+
+
+def marker_row(version=EXPORT_VERSION) -> list:
+    return [EXPORT_MARKER, version]
+
+
+def read_version(row) -> int:
+    """
+    Reads the format version from the first row of an export.
+    :param row: First row of the export.
+    :return: Format version, or None if the row is a regular message row (legacy export).
+    """
+    if row and row[0] == EXPORT_MARKER:
+        return int(row[1])
+    return None
+
+
+def encode_column(value) -> str:
+    """
+    Encodes a structured column (embeds, reactions, attachments, stickers, components, tags) as JSON.
+    :param value: List or dictionary to encode.
+    :return: Encoded column.
+    """
+    if not value:
+        return '[]'
+    return _encoder.encode(value)
+
+
+def decode_column(text, version=EXPORT_VERSION):
+    """
+    Decodes a structured column without ever evaluating code.
+    :param text: Column text as read from the csv.
+    :param version: Format version of the export the column was read from.
+    :return: Decoded list or dictionary.
+    """
+    if text == '[]':
+        return []
+    if version >= EXPORT_VERSION:
+        return _decode(text)
+    # legacy exports stored python reprs, which literal_eval parses safely
+    return ast.literal_eval(text)
+
+
+def decode_any(text):
+    """
+    Decodes a structured column of unknown version, trying JSON first.
+    :param text: Column text.
+    :return: Decoded list or dictionary.
+    """
+    try:
+        return decode_column(text, EXPORT_VERSION)
+    except ValueError:
+        return decode_column(text, LEGACY_VERSION)
@@ -0,0 +1,39 @@
+import os
+import discord
+
+# lean mode only subscribes to what the archive commands use, for bots that sit in many large guilds
+LEAN_MODE = os.getenv('ZERABOT_LEAN_MODE', '0').lower() in ('1', 'true', 'yes')
+LEAN_MAX_MESSAGES = int(os.getenv('ZERABOT_MAX_MESSAGES', 100))
+
+
+def lean_intents() -> discord.Intents:
+    """
+    Builds the intents the export and import commands need.\n
+    guilds: channels, threads, forums and the boost tier used for upload limits.\n
+    guild_messages: keeps channel.last_message cached, which the thread import deletes.\n
+    message_content: the content of exported messages, which is also gated on history requests.\n
+    Members, presences, reactions, emojis and the rest are never read from the gateway. Owner lookups use query_members
+    with explicit ids and the emoji cache uses fetch_emojis, neither of which needs a cached member list.
+    :return: discord.Intents
+    """
+    intents = discord.Intents.none()
+    intents.guilds = True
+    intents.guild_messages = True
+    intents.message_content = True
+    return intents
+
+
+def client_options(lean: bool = LEAN_MODE) -> dict:
+    """
+    Gets the keyword arguments the bot's client is created with.
+    :param lean: Whether to use the lean intents and bounded caches instead of every intent and discord.py's default caches.
+    :return: Dictionary of client options.
+    """
+    if not lean:
+        return {'intents': discord.Intents.all()}
+    return {
+        'intents': lean_intents(),
+        'max_messages': LEAN_MAX_MESSAGES,
+        'member_cache_flags': discord.MemberCacheFlags.none(),
+        'chunk_guilds_at_startup': False,
+    }
@@ -0,0 +1,125 @@
+import asyncio
+import datetime
+import itertools
+import os
+from util import log_helper
+
+logger = log_helper.get_logger(__name__)
+
+MAX_JOBS = int(os.getenv('ZERABOT_MAX_JOBS', 4))
+FINISHED_JOBS_KEPT = 50
+
+
+class JobConflictException(Exception):
+    def __init__(self, job):
+        self.job = job
+        super().__init__(job)
+
+    def __str__(self):
+        return f"{type(self).__name__} -- job {self.job.id} ({self.job.kind}) is already running in channel {self.job.channel_id}."
+
+
+class Job:
+    """
+    State of a single export or import, replacing the old module globals.
+    """
+    def __init__(self, job_id: str, kind: str, guild_id: int, channel_id: int, user_id: int, graceful: bool):
+        self.id = job_id
+        self.kind = kind
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.user_id = user_id
+        # graceful jobs poll cancelled between rows, the others have their task cancelled
+        self.graceful = graceful
+        self.cancel_event = asyncio.Event()
+        self.status = 'queued'
+        self.progress = 0
+        self.created = datetime.datetime.now()
+        self.task = None
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+    @property
+    def active(self) -> bool:
+        return self.status in ('queued', 'running')
+
+    def __str__(self):
+        return f'`{self.id}` {self.kind} in <#{self.channel_id}>: {self.status}, {self.progress} rows, started {self.created:%H:%M:%S}'
+
+
+class JobManager:
+    """
+    Runs exports and imports as independent jobs on a bounded worker pool.
+    Jobs get their own id and cancellation flag, and only one job may target a channel at a time.
+    """
+    def __init__(self, max_workers=MAX_JOBS, on_change=None):
+        """
+        :param max_workers: Maximum number of jobs running at once, the rest wait in the queue.
+        :param on_change: Coroutine function called whenever a job starts or finishes.
+        """
+        self.workers = asyncio.Semaphore(max_workers)
+        self.jobs = {}
+        self.ids = itertools.count(1)
+        self.on_change = on_change
+
+    def submit(self, kind: str, interaction, run, channel_id: int = None, graceful=False) -> Job:
+        """
+        Queues a job.
+        :param kind: Short description of the job, e.g. 'import'.
+        :param interaction: Interaction that started the job.
+        :param run: Coroutine function taking the Job.
+        :param channel_id: Channel the job works on, defaults to the interaction's channel.
+        :param graceful: Whether the job checks job.cancelled itself instead of being cancelled outright.
+        :return: The queued Job.
+        """
+        channel_id = channel_id or interaction.channel_id
+        for job in self.jobs.values():
+            if job.active and job.channel_id == channel_id:
+                raise JobConflictException(job)
+        job = Job(str(next(self.ids)), kind, interaction.guild_id, channel_id, interaction.user.id, graceful)
+        self.jobs[job.id] = job
+        job.task = asyncio.ensure_future(self._run(job, run))
+        self._prune()
+        return job
+
+    async def _run(self, job: Job, run):
+        try:
+            async with self.workers:
+                job.status = 'running'
+                await self._changed()
+                try:
+                    await run(job)
+                    job.status = 'cancelled' if job.cancelled else 'done'
+                except Exception as e:
+                    job.status = 'failed'
+                    logger.error('Job %s (%s) failed: %s', job.id, job.kind, e)
+        except asyncio.CancelledError:
+            job.status = 'cancelled'
+        finally:
+            await self._changed()
+
+    async def _changed(self):
+        if self.on_change:
+            try:
+                await self.on_change(self)
+            except Exception as e:
+                logger.error('Job change callback failed: %s', e)
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self.jobs.items() if not job.active]
+        for job_id in finished[:max(0, len(finished) - FINISHED_JOBS_KEPT)]:
+            del self.jobs[job_id]
+
+    def cancel(self, job: Job):
+        job.cancel_event.set()
+        if not job.graceful or job.status == 'queued':
+            job.task.cancel()
+
+    def active(self, guild_id: int = None) -> list:
+        return [job for job in self.jobs.values() if job.active and (guild_id is None or job.guild_id == guild_id)]
+
+    @property
+    def running(self) -> int:
+        return sum(1 for job in self.jobs.values() if job.status == 'running')
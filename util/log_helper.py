@@ -1,4 +1,10 @@
+import atexit
+import copy
+import json
 import logging
+import logging.handlers
+import os
+import queue
 
 
 class ProjectLogFilter(logging.Filter):
@@ -33,12 +39,82 @@ class ColorFormatter(logging.Formatter):
         return f'{color}{log}{self.RESET}'
 
 
+class JsonFormatter(logging.Formatter):
+    """
+    Formats records as one JSON object per line, for the file sink.
+    """
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'line': record.lineno,
+            'message': record.getMessage(),
+        }
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class TracebackQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that formats the message on the calling thread like the stock one, but keeps the traceback apart in
+    exc_text instead of merging it into the message, so the file sink can give it its own field.
+    """
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # the traceback is rendered here, the frames it references are not handed to the listener thread
+            record.exc_text = record.exc_text or logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+LOG_LEVEL = os.getenv('ZERABOT_LOG_LEVEL', 'INFO').upper()
+# JSON-lines file sink, disabled unless a path is set
+LOG_FILE = os.getenv('ZERABOT_LOG_FILE')
+LOG_FILE_BYTES = int(os.getenv('ZERABOT_LOG_FILE_BYTES', 10_000_000))
+LOG_FILE_BACKUPS = int(os.getenv('ZERABOT_LOG_FILE_BACKUPS', 5))
+
+_listener = None
+
+
+def _setup():
+    """
+    Installs the handlers once on the project's root logger. Records are queued by the caller and written to stderr
+    (and the file sink) by a background listener thread, so a slow terminal never blocks the event loop.
+    :return: Void
+    """
+    global _listener
+    root = logging.getLogger('zerabot')
+    root.setLevel(LOG_LEVEL)
+    root.propagate = False
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(ColorFormatter(fmt='%(asctime)s - AT %(lineno)d - %(levelname)s - %(name)s - %(message)s'))
+    stream_handler.addFilter(ProjectLogFilter())
+    handlers = [stream_handler]
+    if LOG_FILE:
+        file_handler = logging.handlers.RotatingFileHandler(LOG_FILE, maxBytes=LOG_FILE_BYTES, backupCount=LOG_FILE_BACKUPS, encoding='utf-8')
+        file_handler.setFormatter(JsonFormatter())
+        handlers.append(file_handler)
+    log_queue = queue.SimpleQueue()
+    # the message is formatted on the calling thread, while the arguments can't change under it
+    root.addHandler(TracebackQueueHandler(log_queue))
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    # flushes whatever is still queued on exit
+    atexit.register(_listener.stop)
+
+
 def get_logger(name):
-    logger = logging.getLogger(f'zerabot.{name}')
-    logger.setLevel(logging.DEBUG)
-    handler = logging.StreamHandler()
-    handler.setLevel(logging.DEBUG)
-    handler.setFormatter(ColorFormatter(fmt='%(asctime)s - AT %(lineno)d - %(levelname)s - %(name)s - %(message)s'))
-    handler.addFilter(ProjectLogFilter())
-    logger.addHandler(handler)
-    return logger
+    """
+    Gets a project logger. Levels are inherited from the zerabot logger, set through ZERABOT_LOG_LEVEL.
+    Pass arguments %-style (logger.debug('Indexed %d threads', count)) so disabled levels never format anything.
+    :param name: Module name.
+    :return: logging.Logger
+    """
+    if _listener is None:
+        _setup()
+    return logging.getLogger(f'zerabot.{name}')
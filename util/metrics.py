@@ -0,0 +1,193 @@
+import bisect
+import contextlib
+import os
+import time
+from util import log_helper
+
+logger = log_helper.get_logger(__name__)
+
+METRICS_HOST = os.getenv('ZERABOT_METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('ZERABOT_METRICS_PORT', 0))
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_registry = []
+
+
+def _label_text(names, values) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, values)) + '}'
+
+
+class Counter:
+    """
+    Monotonically increasing count, optionally split by labels.
+    """
+    type = 'counter'
+
+    def __init__(self, name: str, description: str, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = {}
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, key, value
+
+    def summary(self):
+        for key, value in self.values.items():
+            yield key, f'{value:g}'
+
+
+class Gauge(Counter):
+    """
+    Value that goes up and down, such as the number of requests in flight.
+    """
+    type = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        self.values[tuple(labels[name] for name in self.labels)] = value
+
+    @contextlib.contextmanager
+    def track(self, **labels):
+        """
+        Counts the enclosed block as in flight while it runs.
+        """
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram:
+    """
+    Distribution of durations (or sizes) in cumulative buckets, with their count and sum.
+    """
+    type = 'histogram'
+
+    def __init__(self, name: str, description: str, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # per label set: [bucket counts..., +Inf count], sum
+        self.values = {}
+        _registry.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        entry = self.values.get(key)
+        if entry is None:
+            entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """
+        Observes the time the enclosed block takes, in seconds.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        for key, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                yield f'{self.name}_bucket', (*key, bound), cumulative
+            yield f'{self.name}_sum', key, total
+            yield f'{self.name}_count', key, cumulative
+
+    def summary(self):
+        for key, (counts, total) in self.values.items():
+            count = sum(counts)
+            yield key, f'{count} in {total:.2f}s (avg {total / count * 1000:.1f}ms)'
+
+
+def render() -> str:
+    """
+    Renders every metric in the Prometheus text exposition format.
+    :return: Metrics text.
+    """
+    lines = []
+    for metric in _registry:
+        lines.append(f'# HELP {metric.name} {metric.description}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        for name, key, value in metric.samples():
+            label_names = (*metric.labels, 'le') if name.endswith('_bucket') else metric.labels
+            lines.append(f'{name}{_label_text(label_names, key)} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def summary() -> str:
+    """
+    Summarises every metric that has been recorded, for the stats command.
+    :return: Human readable summary.
+    """
+    lines = []
+    for metric in _registry:
+        for key, text in metric.summary():
+            lines.append(f'{metric.name}{_label_text(metric.labels, key)}: {text}')
+    return '\n'.join(lines) or 'Nothing recorded yet.'
+
+
+_server = None
+
+
+async def start_server(host=METRICS_HOST, port=METRICS_PORT):
+    """
+    Serves the metrics for Prometheus on /metrics. Does nothing if no port is configured or the server is already running.
+    :return: Void
+    """
+    global _server
+    if not port or _server is not None:
+        return
+    # the web server is only imported when metrics are actually served
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(text=render(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    _server = web.AppRunner(app, access_log=None)
+    await _server.setup()
+    await web.TCPSite(_server, host, port).start()
+    logger.info('Serving metrics on http://%s:%s/metrics', host, port)
+
+
+async def stop_server():
+    global _server
+    if _server is not None:
+        await _server.cleanup()
+        _server = None
+
+
+history_messages = Counter('zerabot_history_messages_total', 'Messages walked in channel histories.')
+history_wait = Histogram('zerabot_history_wait_seconds', 'Time spent waiting on channel history per message.', buckets=(0.0001, 0.001, 0.01, 0.1, 0.5, 1, 5))
+thread_association = Histogram('zerabot_thread_association_seconds', 'Time to associate a thread sysmessage with its thread.')
+encode_rows = Counter('zerabot_export_rows_total', 'Rows written to exports.')
+encode_time = Histogram('zerabot_export_encode_seconds', 'Time to encode one message into an export row.', buckets=(0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.01))
+attachment_downloads = Histogram('zerabot_attachment_download_seconds', 'Attachment and sticker download time.')
+attachment_bytes = Counter('zerabot_attachment_bytes_total', 'Attachment and sticker bytes downloaded.')
+attachments_in_flight = Gauge('zerabot_attachment_downloads_in_flight', 'Attachment downloads in progress.')
+webhook_sends = Histogram('zerabot_webhook_send_seconds', 'Webhook send time, including discord.py retries.')
+webhook_sends_in_flight = Gauge('zerabot_webhook_sends_in_flight', 'Webhook sends in progress.')
+rate_limited = Counter('zerabot_rate_limited_total', '429 responses received by webhooks.')
+rate_limit_wait = Histogram('zerabot_rate_limit_wait_seconds', 'Time spent waiting for a webhook bucket or the global budget.')
+followups = Histogram('zerabot_import_followup_seconds', 'Time spent on follow-ups after a message is posted.', labels=('kind',))
+imported_rows = Counter('zerabot_import_rows_total', 'Rows imported.')
@@ -0,0 +1,127 @@
+import asyncio
+import collections
+import os
+import time
+import discord
+from util import log_helper
+
+logger = log_helper.get_logger(__name__)
+
+USER_CACHE_SIZE = int(os.getenv('ZERABOT_USER_CACHE_SIZE', 10_000))
+USER_CACHE_TTL = float(os.getenv('ZERABOT_USER_CACHE_TTL', 3600))
+QUERY_MEMBERS_BATCH = 100
+
+
+class LookupStats:
+    """
+    Hit and miss counters for the user lookups of a single job.
+    """
+    def __init__(self):
+        self.client_hits = 0
+        self.cache_hits = 0
+        self.misses = 0
+
+    def __str__(self):
+        return f'{self.client_hits} client cache hits, {self.cache_hits} lookup cache hits, {self.misses} misses'
+
+
+class UserResolver:
+    """
+    Resolves user ids through the client cache first, then an LRU of fetched users with TTL eviction, and only then the API.
+    Concurrent lookups of the same id share one request.
+    """
+    def __init__(self, client, max_size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.client = client
+        self.max_size = max_size
+        self.ttl = ttl
+        self.cache = collections.OrderedDict()
+        self.in_flight = {}
+
+    def _cached(self, user_id: int, stats: LookupStats):
+        user = self.client.get_user(user_id)
+        if user:
+            stats.client_hits += 1
+            return True, user
+        entry = self.cache.get(user_id)
+        if entry and entry[1] > time.monotonic():
+            self.cache.move_to_end(user_id)
+            stats.cache_hits += 1
+            return True, entry[0]
+        if entry:
+            del self.cache[user_id]
+        return False, None
+
+    def _store(self, user_id: int, user):
+        # deleted users are cached as None so they are not refetched for every thread they own
+        self.cache[user_id] = (user, time.monotonic() + self.ttl)
+        self.cache.move_to_end(user_id)
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+
+    async def _fetch(self, user_id: int):
+        try:
+            user = await self.client.fetch_user(user_id)
+        except discord.NotFound:
+            user = None
+        except discord.HTTPException as e:
+            # a single failed lookup must not fail every other lookup of the batch
+            logger.warning('Could not fetch user %s: %s', user_id, e)
+            user = None
+        self._store(user_id, user)
+        return user
+
+    async def resolve(self, user_id: int, stats: LookupStats = None):
+        """
+        Resolves a single user.
+        :param user_id: Id of the user.
+        :param stats: Counters of the job the lookup belongs to.
+        :return: discord.User, or None if the user no longer exists.
+        """
+        stats = stats or LookupStats()
+        found, user = self._cached(user_id, stats)
+        if found:
+            return user
+        if user_id in self.in_flight:
+            stats.cache_hits += 1
+            return await self.in_flight[user_id]
+        stats.misses += 1
+        task = asyncio.ensure_future(self._fetch(user_id))
+        self.in_flight[user_id] = task
+        try:
+            return await task
+        finally:
+            del self.in_flight[user_id]
+
+    async def resolve_many(self, user_ids, guild=None, stats: LookupStats = None) -> dict:
+        """
+        Resolves several users at once. Misses are batched through the gateway member query when a guild is given,
+        anything still missing is fetched individually.
+        :param user_ids: Ids of the users.
+        :param guild: Guild the users are likely members of.
+        :param stats: Counters of the job the lookups belong to.
+        :return: Dictionary of user id to discord.User (or None).
+        """
+        stats = stats or LookupStats()
+        users = {}
+        misses = []
+        for user_id in dict.fromkeys(user_ids):
+            found, user = self._cached(user_id, stats)
+            if found:
+                users[user_id] = user
+            else:
+                misses.append(user_id)
+        if misses and guild is not None:
+            for i in range(0, len(misses), QUERY_MEMBERS_BATCH):
+                try:
+                    members = await guild.query_members(user_ids=misses[i:i + QUERY_MEMBERS_BATCH], cache=False)
+                except (discord.ClientException, asyncio.TimeoutError) as e:
+                    logger.debug('Member query unavailable, falling back to fetching users: %s', e)
+                    break
+                for member in members:
+                    stats.misses += 1
+                    self._store(member.id, member)
+                    users[member.id] = member
+        remaining = [user_id for user_id in misses if user_id not in users]
+        fetched = await asyncio.gather(*[self.resolve(user_id, stats) for user_id in remaining])
+        users.update(zip(remaining, fetched))
+        return users
@@ -1,11 +1,15 @@
-import ast
+import asyncio
+import collections
+import hashlib
 import importlib
-import io
+import json
 import os
 import re
+import tempfile
+import time
 import aiohttp
 from discord import app_commands as ap
-from util import log_helper
+from util import log_helper, webhooks, codec, archive, metrics
 from data import embeds as em
 from data.exceptions import *
 import discord
@@ -14,8 +18,6 @@ import csv
 
 logger = log_helper.get_logger(__name__)
 
-should_stop = False
-
 async def load_command_groups(bot, module_name: str):
     """
     Loads command groups from a file.
@@ -23,7 +25,7 @@ async def load_command_groups(bot, module_name: str):
     :param module_name: File to load the commands from.
     :return: Void
     """
-    logger.debug(f"Loading command groups from {module_name}.")
+    logger.debug('Loading command groups from %s.', module_name)
     module = importlib.import_module(module_name)
     instances = {}
 
@@ -32,23 +34,56 @@ async def load_command_groups(bot, module_name: str):
         if isinstance(attr, type) and issubclass(attr, ap.Group) and attr is not ap.Group:
             instance = attr()
             instances[attr_name] = instance
-    logger.debug(instances)
+    logger.debug('%s', instances)
 
     for name, instance in instances.items():
         parent_name = type(instance.parent).__name__ if instance.parent else None
-        logger.debug(f"Checking command group {name}.")
-        logger.debug(f'Parent name: {parent_name if parent_name else "None"}')
+        logger.debug('Checking command group %s.', name)
+        logger.debug('Parent name: %s', parent_name)
         if parent_name and parent_name in instances:
-            logger.debug(f'adding {instance} to {parent_name}')
+            logger.debug('adding %s to %s', instance, parent_name)
             instances[parent_name].add_command(instance)
-        logger.debug(f"Checked command group {name}." + (f" Parent: {parent_name}" if instance.parent else ''))
+        logger.debug('Checked command group %s. Parent: %s', name, parent_name)
 
     for name, instance in instances.items():
         if not instance.parent:
-            logger.debug(f'loading {instance}')
+            logger.debug('loading %s', instance)
             bot.tree.add_command(instance)
-            logger.debug(f'loaded {instance}')
+            logger.debug('loaded %s', instance)
+
+
+COMMAND_TREE_HASH_FILE = os.getenv('ZERABOT_COMMAND_TREE_HASH_FILE', '.command_tree_hash')
+
+def command_tree_hash(tree, application_id) -> str:
+    """
+    Hashes the payload a global sync would upload for a command tree.
+    :param tree: Command tree to hash.
+    :param application_id: Application the tree is synced to.
+    :return: Hex digest.
+    """
+    commands = sorted((command.to_dict(tree) for command in tree.get_commands()), key=lambda command: command['name'])
+    payload = json.dumps([application_id, commands], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
 
+async def sync_command_tree(bot, hash_file: str = COMMAND_TREE_HASH_FILE) -> bool:
+    """
+    Syncs the command tree globally, but only if it changed since the last sync. Delete the hash file to force a sync.
+    :param bot: Bot whose tree to sync.
+    :param hash_file: File the hash of the last synced tree is kept in.
+    :return: Whether the tree was synced.
+    """
+    digest = command_tree_hash(bot.tree, bot.application_id)
+    if os.path.exists(hash_file):
+        with open(hash_file, 'r', encoding='utf-8') as file:
+            if file.read().strip() == digest:
+                logger.info('Command tree unchanged, skipping sync.')
+                return False
+    syncs = await bot.tree.sync()
+    logger.info('Synced %d commands.', len(syncs))
+    with open(f'{hash_file}.tmp', 'w', encoding='utf-8') as file:
+        file.write(digest)
+    os.replace(f'{hash_file}.tmp', hash_file)
+    return True
 
 async def get_message_count(channel: discord.TextChannel):
     """
@@ -58,40 +93,238 @@ async def get_message_count(channel: discord.TextChannel):
     """
     start_time = datetime.datetime.now()
     message_count = 0
-    async for _ in channel.history(limit=None):
+    async for _ in paced_history(channel, limit=None):
         message_count += 1
     end_time = datetime.datetime.now()
     time_taken = end_time - start_time
-    logger.debug(f"Counted {message_count} messages in {time_taken.total_seconds()} seconds.")
+    logger.debug('Counted %d messages in %s seconds.', message_count, time_taken.total_seconds())
     return message_count, time_taken.total_seconds()
 
-async def write_messages_csv(messages, file_name: str) -> discord.File:
+CSV_BUFFER_ROWS = 500
+
+JOURNAL_DIGEST_CHUNK = 1 << 20
+
+class ImportJournal:
+    """
+    Append-only journal of an import. Every posted row commits one line holding the row's position in the source, its original id, the id of its imported copy and whether that copy is still to be pinned.
+    Resuming seeks the source straight past the last committed row, and the journal doubles as the original id -> imported id map used to thread replies.
+    The header records the size and digest of the source, so a source that was only appended to since (by an incremental export) still resumes.
+    """
+    def __init__(self, file_name: str, source, source_size: int, restart=False):
+        """
+        :param file_name: Journal file.
+        :param source: Binary file object of the source being imported.
+        :param source_size: Size of the source being imported.
+        :param restart: Discard an existing journal and start over.
+        :raises ImportSourceChangedException: If an existing journal was written for a different source.
+        """
+        self.file_name = file_name
+        self.ids = {}
+        self.pins = []
+        self.position = None
+        self.committed = 0
+        if os.path.exists(file_name) and restart:
+            logger.info('Starting %s over.', file_name)
+            os.remove(file_name)
+        if os.path.exists(file_name):
+            with open(file_name, 'r', newline='', encoding='utf-8') as file:
+                reader = csv.reader(file)
+                header = next(reader, None)
+                if header and not self._same_source(header, source, source_size):
+                    raise ImportSourceChangedException(file_name)
+                for position, original_id, new_id, *pin in reader:
+                    self.position = int(position)
+                    self.committed += 1
+                    if int(new_id):
+                        self.ids[int(original_id)] = int(new_id)
+                    if pin and int(pin[0]):
+                        self.pins.append(int(new_id))
+                logger.info('Resuming %s after %d committed rows.', file_name, self.committed)
+        fresh = not os.path.exists(file_name)
+        self.file = open(file_name, 'a', newline='', encoding='utf-8')
+        self.writer = csv.writer(self.file)
+        if fresh:
+            self.writer.writerow(['source_size', source_size, 'source_digest', self._digest(source, source_size)])
+            self.file.flush()
+
+    @staticmethod
+    def _digest(source, size: int) -> str:
+        """
+        Hashes the first size bytes of the source, leaving its position where it was.
+        """
+        position = source.tell()
+        source.seek(0)
+        digest = hashlib.sha256()
+        while size > 0:
+            chunk = source.read(min(size, JOURNAL_DIGEST_CHUNK))
+            if not chunk:
+                break
+            digest.update(chunk)
+            size -= len(chunk)
+        source.seek(position)
+        return digest.hexdigest()
+
+    def _same_source(self, header: list, source, source_size: int) -> bool:
+        """
+        Checks whether the journal was written for this source, or for the same source before rows were appended to it.
+        """
+        recorded_size = int(header[1])
+        if len(header) < 4:
+            # journals without a digest can only be matched by size
+            return recorded_size == source_size
+        if recorded_size > source_size or self._digest(source, recorded_size) != header[3]:
+            return False
+        if recorded_size < source_size:
+            logger.info('%s grew by %d bytes since the import started, resuming where it stopped.', self.file_name, source_size - recorded_size)
+        return True
+
+    def commit(self, position: int, original_id, new_id: int = 0, pin=False):
+        """
+        Records a posted row.
+        :param position: Position of the row in the source, as returned by offset_of.
+        :param original_id: Original id of the message.
+        :param new_id: Id of the imported message, 0 if nothing can be replied to.
+        :param pin: Whether the imported message still has to be pinned.
+        :return: Void
+        """
+        pin = bool(pin and new_id)
+        if new_id:
+            self.ids[int(original_id)] = new_id
+        if pin:
+            self.pins.append(new_id)
+        self.position = position
+        self.committed += 1
+        self.writer.writerow([position, int(original_id), new_id, 1 if pin else 0])
+        self.file.flush()
+
+    def get(self, original_id):
+        return self.ids.get(int(original_id))
+
+    def close(self, delete=False):
+        """
+        Closes the journal.
+        :param delete: Whether to remove the journal, once the import has completed.
+        :return: Void
+        """
+        self.file.close()
+        if delete and os.path.exists(self.file_name):
+            os.remove(self.file_name)
+
+class MessageIndex:
+    """
+    Set of message ids exported so far, built incrementally as the export streams.
+    Replies always point backwards, so a reference that is not in the index when the reply
+    streams past lies outside the export window (deleted, filtered out or in another channel).
     """
-    Writes messages to a csv file.\n
-    messages are stored in the following format:\n
-    [author's name, author's avatar url, message content, message embeds, message id, message reference id (reply id), interaction name, interaction user's name, message reactions, message attachments, message stickers, message components, boolean whether the message is pinned (0 or 1), thread flag (0, 1, 2, or thread id)]
-    :param message: Messages to write to the file.
+    def __init__(self, floor: int = 0):
+        """
+        :param floor: Highest message id already in the archive when appending, anything at or below it counts as exported.
+        """
+        self.ids = set()
+        self.floor = floor
+        self.dangling = 0
+
+    def add(self, message_id: int):
+        self.ids.add(message_id)
+
+    def resolve(self, message_id: int) -> bool:
+        """
+        Checks whether a reply target is part of the export, counting it as dangling if not.
+        :param message_id: Id of the referenced message.
+        :return: Whether the referenced message was exported.
+        """
+        if message_id in self.ids or message_id <= self.floor:
+            return True
+        self.dangling += 1
+        return False
+
+    def __contains__(self, message_id):
+        return message_id in self.ids
+
+    def __len__(self):
+        return len(self.ids)
+
+async def _aiter_messages(messages):
+    """
+    Normalises a list or async iterable of messages into an async iterator.
+    :param messages: List (oldest first) or async iterable of messages.
+    :return: Async iterator of messages.
+    """
+    if hasattr(messages, '__aiter__'):
+        async for message in messages:
+            yield message
+    else:
+        for message in messages:
+            yield message
+
+async def write_messages_csv(messages, file_name: str, state: dict = None) -> discord.File:
+    """
+    Writes messages to a csv file, or a compressed archive if the file name ends in .zarc, as they arrive, keeping at most CSV_BUFFER_ROWS rows in memory.\n
+    The first row is the export marker with the format version, messages are stored in the following format:\n
+    [author's name, author's avatar url, message content, message embeds, message id, message reference id (reply id), interaction name, interaction user's name, message reactions, message attachments, message stickers, message components, boolean whether the message is pinned (0 or 1), thread flag (0, 1, 2, or thread id)]\n
+    Embeds, reactions, attachments, stickers and components are JSON encoded.
+    :param messages: Messages to write to the file, oldest first. Either a list or an async iterable such as stream_messages.
+    :param state: Export state (see load_export_state). When it has a last_id, rows are appended to the existing csv file, and it is updated with the new last_id and checkpoints and saved at every flush.
     :return: discord.File
     """
-    # reversed because discord returns channel history from newest to oldest
-    messages = messages[::-1]
-    with open(file_name, 'w', newline='', encoding="utf-8") as file:
+    append = bool(state and state.get('last_id'))
+    index = MessageIndex(state['last_id'] if append else 0)
+    thread_index = None
+    buffer = []
+    last_id = state['last_id'] if append else 0
+    if file_name.endswith(archive.ARCHIVE_EXTENSION):
+        file = writer = archive.ArchiveWriter(file_name)
+    else:
+        file = open(file_name, 'a' if append else 'w', newline='', encoding="utf-8")
         writer = csv.writer(file)
-        for message in messages:
+        if state is not None and not append:
+            # the file was just started over, a state left by an earlier export no longer describes it
+            state.clear()
+            save_export_state(file_name, state)
+
+    def flush():
+        tracked = state is not None and buffer and not isinstance(file, archive.ArchiveWriter)
+        if tracked:
+            # buffers always end on a message boundary, so each checkpoint is a safe place to truncate and refetch from
+            state.setdefault('checkpoints', []).append([buffer[0][4], file.tell()])
+        writer.writerows(buffer)
+        buffer.clear()
+        if tracked:
+            # the state is saved with every flush, so a run that fails or is cancelled leaves the file and state in agreement
+            file.flush()
+            state['last_id'] = last_id
+            state['size'] = file.tell()
+            save_export_state(file_name, state)
+
+    with file:
+        if not append:
+            writer.writerow(codec.marker_row())
+        async for message in _aiter_messages(messages):
+            index.add(message.id)
+            last_id = max(last_id, message.id)
 
             if message.type == discord.MessageType.thread_created:
                 # if the message isnt a thread sysmessage, this code wont run and the flag is 0
                 # if the message has no thread, the flag is 1
                 # if the message has a thread but it couldnt be associated, the flag is 2
                 # if the message has a thread and it could be associated, the flag is the thread id
-                thread = await associate_thread(message)
+                if thread_index is None:
+                    thread_index = ThreadIndex(message.channel)
+                with metrics.thread_association.time():
+                    thread = await associate_thread(message, thread_index)
                 thread_flag = 1
                 if thread:
                     thread_flag = thread.id
                 else:
                     thread_flag = 2 if message.flags.value == 32 else 1
-                writer.writerow([message.author.name, message.author.display_avatar.url, "thread placeholder text" if not thread else thread.name, [], message.id, 0, 0, 0, [], [], [], [], 0, thread_flag])
-            
+                buffer.append([message.author.name, message.author.display_avatar.url, "thread placeholder text" if not thread else thread.name, [], message.id, 0, 0, 0, [], [], [], [], 0, thread_flag])
+                metrics.encode_rows.inc()
+                # the placeholder is the sysmessage's only row
+                if len(buffer) >= CSV_BUFFER_ROWS:
+                    flush()
+                continue
+
+            encode_start = time.perf_counter()
             embeds = []
             for embed in message.embeds:
                 embeds.append(embed.to_dict())
@@ -111,28 +344,259 @@ async def write_messages_csv(messages, file_name: str) -> discord.File:
             components = []
             for component in message.components:
                 components.append(component_to_dict(component))
-            if message.reference:
-                for message2 in messages:
-                    if message2.id == message.reference.message_id:
-                        writer.writerow([message.author.name, message.author.display_avatar.url, message.content, embeds, message.id, message.reference.message_id, 0, 0, emojis, attachments, stickers, components, 1 if message.pinned else 0, 0])
+            # thread sysmessages carry a reference to the thread's channel without a message id, they are not replies
+            if message.reference and message.reference.message_id:
+                # replies to messages outside the export are still written with their reference id,
+                # the importer posts them as regular messages marked as orphaned replies
+                index.resolve(message.reference.message_id)
+                buffer.append([message.author.name, message.author.display_avatar.url, message.content, codec.encode_column(embeds), message.id, message.reference.message_id, 0, 0, codec.encode_column(emojis), codec.encode_column(attachments), codec.encode_column(stickers), codec.encode_column(components), 1 if message.pinned else 0, 0])
             elif message.type == discord.MessageType.chat_input_command:
-                writer.writerow([message.author.name, message.author.display_avatar.url, message.content, embeds, message.id, 0, message.interaction.name, message.interaction.user.name, emojis, attachments, stickers, components, 1 if message.pinned else 0, 0])
+                buffer.append([message.author.name, message.author.display_avatar.url, message.content, codec.encode_column(embeds), message.id, 0, message.interaction.name, message.interaction.user.name, codec.encode_column(emojis), codec.encode_column(attachments), codec.encode_column(stickers), codec.encode_column(components), 1 if message.pinned else 0, 0])
             else:
-                writer.writerow([message.author.name, message.author.display_avatar.url, message.content, embeds, message.id, 0, 0, 0, emojis, attachments, stickers, components, 1 if message.pinned else 0, 0])
-        return discord.File(file_name, filename='export.csv')
-    
+                buffer.append([message.author.name, message.author.display_avatar.url, message.content, codec.encode_column(embeds), message.id, 0, 0, 0, codec.encode_column(emojis), codec.encode_column(attachments), codec.encode_column(stickers), codec.encode_column(components), 1 if message.pinned else 0, 0])
+            metrics.encode_time.observe(time.perf_counter() - encode_start)
+            metrics.encode_rows.inc()
 
-async def read_attachment_url(url: str) -> (bytes, int):
+            if len(buffer) >= CSV_BUFFER_ROWS:
+                flush()
+        flush()
+        if state is not None:
+            state['last_id'] = last_id
+        if index.dangling:
+            logger.info('%d replies in %s point to messages outside the export.', index.dangling, file_name)
+    return discord.File(file_name, filename=f'export{os.path.splitext(file_name)[1]}')
+
+def load_export_state(file_name: str) -> dict:
+    """
+    Loads the state recorded by the last export into a file: the highest exported message id and
+    checkpoints of (first message id, byte offset) at every buffer flush.
+    :param file_name: Export file.
+    :return: State dictionary, empty if there is no usable previous export.
+    """
+    if not os.path.exists(file_name) or not os.path.exists(f'{file_name}.state.json'):
+        return {}
+    with open(file_name, 'rb') as file:
+        if open_rows(file).version != codec.EXPORT_VERSION:
+            logger.warning('%s uses an older export format, it will be exported again in full.', file_name)
+            return {}
+    with open(f'{file_name}.state.json', 'r', encoding='utf-8') as file:
+        state = json.load(file)
+    size = os.path.getsize(file_name)
+    if 'size' in state and size != state['size']:
+        if size < state['size']:
+            logger.warning('%s is shorter than its export state, it will be exported again in full.', file_name)
+            return {}
+        # rows written after the last saved flush, e.g. when the process died in between, are fetched again
+        with open(file_name, 'r+b') as file:
+            file.truncate(state['size'])
+        logger.info('Truncated %s back to its last saved flush.', file_name)
+    return state
+
+def save_export_state(file_name: str, state: dict):
+    with open(f'{file_name}.state.json.tmp', 'w', encoding='utf-8') as file:
+        json.dump(state, file)
+    os.replace(f'{file_name}.state.json.tmp', f'{file_name}.state.json')
+
+def rewind_export(file_name: str, state: dict, since: datetime.datetime):
+    """
+    Truncates an export back to the last checkpoint before a point in time, so the messages after it are fetched again
+    with their current edits and reactions.
+    :param file_name: Export file.
+    :param state: Export state, updated in place.
+    :param since: Start of the window to re-sync.
+    :return: Void
+    """
+    window_id = discord.utils.time_snowflake(since)
+    checkpoints = state.get('checkpoints', [])
+    keep = [checkpoint for checkpoint in checkpoints if checkpoint[0] <= window_id]
+    if not checkpoints:
+        return
+    # the checkpoint the file is cut at is rewritten along with everything after it
+    message_id, offset = keep[-1] if keep else checkpoints[0]
+    state['checkpoints'] = keep[:-1] if keep else []
+    state['last_id'] = message_id - 1
+    state['size'] = offset
+    with open(file_name, 'r+b') as file:
+        file.truncate(offset)
+    # saved straight away, a failed re-sync then resumes from the rewound file instead of skipping the cut rows
+    save_export_state(file_name, state)
+    logger.info('Rewound %s to message %s to re-sync edits since %s.', file_name, message_id, since)
+
+async def export_messages(channel, file_name: str, slices=1, incremental=False, resync: datetime.timedelta = None):
+    """
+    Streams a channel's history straight into a csv file or compressed archive.
+    :param channel: Channel to export.
+    :param file_name: File to write the export to.
+    :param slices: Number of time slices to fetch the history in concurrently.
+    :param incremental: Only fetch messages newer than the last export into the same csv file and append them.
+    :param resync: When exporting incrementally, also refetch the messages of this recent window to pick up edits and reactions.
+    :return: Tuple of the written discord.File, total message count and exported message count.
+    """
+    stats = {}
+    state = load_export_state(file_name) if incremental and not file_name.endswith(archive.ARCHIVE_EXTENSION) else {}
+    if state and resync:
+        rewind_export(file_name, state, discord.utils.utcnow() - resync)
+    after = discord.Object(state['last_id']) if state.get('last_id') else None
+    if after:
+        logger.info('Exporting %s incrementally after message %s.', channel.id, after.id)
+    file = await write_messages_csv(stream_messages(channel, stats, oldest_first=True, slices=slices, after=after), file_name, state)
+    if not file_name.endswith(archive.ARCHIVE_EXTENSION):
+        save_export_state(file_name, state)
+    return file, stats['total'], stats['fetched']
+
+ATTACHMENT_SPOOL_BYTES = 1_000_000
+ATTACHMENT_CHUNK_BYTES = 64 * 1024
+
+_http_session = None
+
+def get_http_session() -> aiohttp.ClientSession:
+    """
+    Gets the connection pool shared by every attachment transfer and webhook send, creating it on first use.
+    :return: Shared aiohttp session.
+    """
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        # webhooks are sent through this session too, so rate limit headers are traced on every response
+        _http_session = aiohttp.ClientSession(trace_configs=[webhooks.rate_limits.trace_config()])
+    return _http_session
+
+async def close_http_session():
+    """
+    Closes the shared connection pool. Called when the bot shuts down.
+    :return: Void
     """
-    Reads an attachment URL and returns file bytes and file size.
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+
+async def read_attachment_url(url: str, max_size: int = None) -> (tempfile.SpooledTemporaryFile, int):
+    """
+    Streams an attachment URL into a spooled temp file that only stays in memory while it is small.
+    The size is checked against Content-Length before the body is downloaded.
     :param url: URL to read.
-    :return: Tuple containing file bytes and file size.
+    :param max_size: Largest accepted size in bytes. Larger files are not downloaded and None is returned in place of the stream.
+    :return: Tuple containing the file stream and file size.
     """
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as resp:
-            stream = io.BytesIO(await resp.read())
-            return stream, resp.content_length
+    with metrics.attachments_in_flight.track(), metrics.attachment_downloads.time():
+        async with get_http_session().get(url) as resp:
+            if max_size is not None and resp.content_length is not None and resp.content_length > max_size:
+                return None, resp.content_length
+            stream = tempfile.SpooledTemporaryFile(max_size=ATTACHMENT_SPOOL_BYTES)
+            size = 0
+            async for chunk in resp.content.iter_chunked(ATTACHMENT_CHUNK_BYTES):
+                size += len(chunk)
+                if max_size is not None and size > max_size:
+                    # no Content-Length was sent, stop as soon as the limit is crossed
+                    stream.close()
+                    return None, size
+                stream.write(chunk)
+            stream.seek(0)
+            metrics.attachment_bytes.inc(size)
+            return stream, size
         
+PREFETCH_ROWS = int(os.getenv('ZERABOT_PREFETCH_ROWS', 8))
+PREFETCH_CONCURRENCY = int(os.getenv('ZERABOT_PREFETCH_CONCURRENCY', 4))
+PREFETCH_MEMORY_BYTES = int(os.getenv('ZERABOT_PREFETCH_MEMORY_BYTES', 200_000_000))
+
+class AttachmentPrefetcher:
+    """
+    Downloads the attachments and stickers of the next rows concurrently while the current row is being posted.
+    Rows are handed out strictly in order, together with a task resolving to that row's (files, large_files).
+    """
+    def __init__(self, rows, max_size: int, version=codec.EXPORT_VERSION, lookahead=PREFETCH_ROWS, concurrency=PREFETCH_CONCURRENCY, memory_budget=PREFETCH_MEMORY_BYTES):
+        """
+        :param rows: Iterable of (rownum, row) tuples.
+        :param version: Format version of the export the rows come from.
+        :param max_size: Largest attachment size accepted by the guild.
+        :param lookahead: Number of rows downloaded ahead of the one being posted.
+        :param concurrency: Maximum number of concurrent downloads.
+        :param memory_budget: Soft limit in bytes for downloaded files that have not been posted yet.
+        """
+        self.rows = iter(rows)
+        self.max_size = max_size
+        self.version = version
+        self.lookahead = max(1, lookahead)
+        self.semaphore = asyncio.Semaphore(max(1, concurrency))
+        self.memory_budget = memory_budget
+        self.held = 0
+        self.row_bytes = {}
+        self.budget_changed = asyncio.Condition()
+        self.window = collections.deque()
+        self.current = None
+        self.current_task = None
+        self.exhausted = False
+
+    def _fill(self):
+        while not self.exhausted and len(self.window) < self.lookahead:
+            try:
+                rownum, row = next(self.rows)
+            except StopIteration:
+                self.exhausted = True
+                break
+            self.window.append((rownum, row, asyncio.ensure_future(self._download_row(rownum, row))))
+
+    async def _download_row(self, rownum, row):
+        if int(row[13]) != 0:
+            return [], []
+        attachments = codec.decode_column(row[9], self.version)
+        stickers = codec.decode_column(row[10], self.version)
+        results = await asyncio.gather(*[self._download(rownum, url, self.max_size) for url in attachments],
+                                       *[self._download(rownum, url, None) for url in stickers])
+        files = []
+        large_files = []
+        for url, (stream, size) in zip(attachments + stickers, results):
+            if stream is None:
+                logger.debug('An attachment was too large!')
+                large_files.append(url)
+            else:
+                files.append(discord.File(stream, filename=re.match(r'.*/(.*\.\w+)', url)[0]))
+        return files, large_files
+
+    async def _download(self, rownum, url, max_size):
+        async with self.budget_changed:
+            # the row that is about to be posted is never held back by the budget
+            await self.budget_changed.wait_for(lambda: self.held < self.memory_budget or rownum == self.current)
+        async with self.semaphore:
+            stream, size = await read_attachment_url(url, max_size)
+            if stream is not None:
+                self.held += size
+                self.row_bytes[rownum] = self.row_bytes.get(rownum, 0) + size
+            return stream, size
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        # the previous row has been posted by now, so its files no longer count against the budget
+        self.held -= self.row_bytes.pop(self.current, 0)
+        self._fill()
+        if not self.window:
+            raise StopAsyncIteration
+        rownum, row, task = self.window.popleft()
+        self.current = rownum
+        self.current_task = task
+        self._fill()
+        async with self.budget_changed:
+            self.budget_changed.notify_all()
+        return rownum, row, task
+
+    def close(self):
+        """
+        Cancels pending downloads and closes the files of rows that were never posted.
+        :return: Void
+        """
+        pending = [task for _, _, task in self.window]
+        if self.current_task:
+            pending.append(self.current_task)
+        for task in pending:
+            if task.done() and not task.cancelled() and not task.exception():
+                for file in task.result()[0]:
+                    file.close()
+            else:
+                task.cancel()
+        self.window.clear()
+
 def component_to_dict(component):
     """
     Converts a component to a dictionary.
@@ -193,10 +657,29 @@ class EmptyView(discord.ui.View):
     def __init__(self):
         super().__init__()
 
-async def forum_tag_to_dict(forum_tag: discord.ForumTag, guild):
+class EmojiCache:
+    """
+    Custom emojis of a guild, fetched with a single fetch_emojis call the first time one is needed.
+    """
+    def __init__(self, guild):
+        self.guild = guild
+        self.emojis = None
+
+    async def get(self, emoji_id: int):
+        """
+        Gets a custom emoji of the guild.
+        :param emoji_id: Id of the emoji.
+        :return: discord.Emoji, or None if the guild has no such emoji.
+        """
+        if self.emojis is None:
+            self.emojis = {emoji.id: emoji for emoji in await self.guild.fetch_emojis()}
+            logger.debug('Cached %d emojis of guild %s.', len(self.emojis), self.guild.id)
+        return self.emojis.get(emoji_id)
+
+async def forum_tag_to_dict(forum_tag: discord.ForumTag, emojis: EmojiCache):
     emoji = None
     if forum_tag.emoji:
-        emoji = str(forum_tag.emoji) if forum_tag.emoji.id == None else await guild.fetch_emoji(forum_tag.emoji.id)
+        emoji = str(forum_tag.emoji) if forum_tag.emoji.id == None else await emojis.get(forum_tag.emoji.id)
     return {'emoji': emoji if type(emoji) == str or not emoji else f'<:{emoji.name}:{emoji.id}>',
             'moderated': forum_tag.moderated,
             'name': forum_tag.name,}
@@ -204,85 +687,370 @@ async def forum_tag_to_dict(forum_tag: discord.ForumTag, guild):
 def dict_to_forum_tag(dictionary: dict):
     return discord.ForumTag(emoji=dictionary['emoji'], moderated=dictionary['moderated'], name=dictionary['name'])
 
-async def associate_thread(message) -> discord.Thread:
+class ThreadIndex:
+    """
+    Index of a channel's threads keyed by creation date, built once per export.
+    Covers active threads as well as archived public and private threads.
+    """
+    def __init__(self, channel):
+        self.channel = channel
+        self.threads = None
+
+    async def build(self):
+        """
+        Lists every thread of the channel once and indexes them by creation date.
+        :return: Void
+        """
+        threads = {thread.id: thread for thread in self.channel.threads}
+        async for thread in self.channel.archived_threads(limit=None):
+            threads[thread.id] = thread
+        try:
+            async for thread in self.channel.archived_threads(private=True, limit=None):
+                threads[thread.id] = thread
+        except discord.Forbidden:
+            logger.warning('Missing permissions to list private archived threads in %s.', self.channel.id)
+        self.threads = {}
+        for thread in threads.values():
+            self.threads.setdefault(thread.created_at, []).append(thread)
+        logger.debug('Indexed %d threads in %s.', len(threads), self.channel.id)
+
+    async def lookup(self, message) -> list:
+        """
+        Gets the threads created at the same time as a message, building the index on first use.
+        :param message: Message to match.
+        :return: List of possible matches.
+        """
+        if self.threads is None:
+            await self.build()
+        return self.threads.get(message.created_at, [])
+
+async def associate_thread(message, thread_index: ThreadIndex = None) -> discord.Thread:
     """
     Associates a thread with a message based on the starter message's creation date.
     :param message: Message to associate a thread with.
+    :param thread_index: Index of the channel's threads, shared across an export. A fresh one is built if omitted.
     :return: Associated thread.
     """
     if message.type != discord.MessageType.thread_created:
         raise TypeError('Message is not a thread creation sysmessage.')
-    
-    possible_matches = []
-
-    for thread in message.channel.threads:
-        if thread.created_at == message.created_at:
-            possible_matches.append(thread)
-    async for thread in message.channel.archived_threads():
-        if thread.created_at == message.created_at:
-            possible_matches.append(thread)
+    if thread_index is None:
+        thread_index = ThreadIndex(message.channel)
+
+    possible_matches = await thread_index.lookup(message)
     if (len(possible_matches) == 1):
         return possible_matches[0]
     elif (len(possible_matches) == 0):
         return None
     else:
-        logger.error(DuplicateThreadException(len(possible_matches), message))
+        logger.error('%s', DuplicateThreadException(len(possible_matches), message))
     return None
 
-async def fetch_messages(channel):
-    actually_fetched = 0
-    messages = []
-    # fetch the most recent n messages and add them to the list
-    async for message in channel.history(limit=None):
+EXPORTABLE_TYPES = (
+    discord.MessageType.default,
+    discord.MessageType.reply,
+    discord.MessageType.chat_input_command,
+    discord.MessageType.context_menu_command,
+    discord.MessageType.thread_created,
+)
+
+HISTORY_SLICE_BUFFER = 1000
+HISTORY_SLICE_CONCURRENCY = int(os.getenv('ZERABOT_HISTORY_SLICE_CONCURRENCY', 4))
+# messages discord.py requests per history page
+HISTORY_PAGE_SIZE = 100
+
+async def paced_history(channel, **kwargs):
+    """
+    Walks channel.history, taking a slot of the global request budget before every page discord.py requests.
+    Accepts the same arguments as discord.abc.Messageable.history.
+    :return: Async generator of messages.
+    """
+    await webhooks.global_budget.acquire()
+    count = 0
+    async for message in channel.history(**kwargs):
+        yield message
+        count += 1
+        if count % HISTORY_PAGE_SIZE == 0:
+            # the next message comes from a new page
+            await webhooks.global_budget.acquire()
+
+async def sliced_history(channel, slices: int, after: discord.Object = None, concurrency=HISTORY_SLICE_CONCURRENCY):
+    """
+    Walks a channel's history oldest first by splitting its lifetime into snowflake-bounded slices that are paginated concurrently.
+    Each slice buffers at most HISTORY_SLICE_BUFFER messages ahead of the consumer, and slices are merged back in order.
+    :param channel: Channel to walk.
+    :param slices: Number of time slices.
+    :param after: Only walk the history after this message.
+    :param concurrency: Maximum number of slices paginated at once.
+    :return: Async generator of messages, oldest first.
+    """
+    low = after.id + 1 if after else discord.utils.time_snowflake(channel.created_at)
+    # the cached last message id only spreads the slices, it can be stale so the last slice is left open-ended
+    high = channel.last_message_id or discord.utils.time_snowflake(discord.utils.utcnow())
+    step = max(1, (high + 1 - low) // slices)
+    bounds = [low + i * step for i in range(slices)] + [None]
+    queues = [asyncio.Queue(maxsize=HISTORY_SLICE_BUFFER) for _ in range(slices)]
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def fetch_slice(i):
         try:
-            if message.type == discord.MessageType.default or message.type == discord.MessageType.reply:
-                messages.append(message)
-                actually_fetched += 1
-            elif message.type == discord.MessageType.chat_input_command or message.type == discord.MessageType.context_menu_command:
-                messages.append(message)
-                actually_fetched += 1
-            elif message.type == discord.MessageType.thread_created:
-                messages.append(message)
-                actually_fetched += 1
-            else:
-                logger.info(f'Found a message of type {message.type}.')
+            async with semaphore:
+                # after and before are exclusive, so each slice covers [bounds[i], bounds[i + 1])
+                before = discord.Object(bounds[i + 1]) if bounds[i + 1] is not None else None
+                async for message in paced_history(channel, limit=None, after=discord.Object(bounds[i] - 1), before=before, oldest_first=True):
+                    await queues[i].put(message)
+        except Exception as e:
+            await queues[i].put(e)
+        await queues[i].put(None)
+
+    tasks = [asyncio.ensure_future(fetch_slice(i)) for i in range(slices)]
+    try:
+        for queue in queues:
+            while (item := await queue.get()) is not None:
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+    finally:
+        for task in tasks:
+            task.cancel()
 
+async def stream_messages(channel, stats: dict, oldest_first=False, slices=1, after: discord.Object = None):
+    """
+    Walks a channel's history once, counting every message and yielding the exportable ones as they arrive.
+    :param channel: Channel to walk.
+    :param stats: Dictionary that receives the running 'total' and 'fetched' counts.
+    :param oldest_first: Whether to walk the history from the oldest message.
+    :param slices: Number of time slices to paginate concurrently, only used when walking oldest first.
+    :param after: Only walk the history after this message.
+    :return: Async generator of exportable messages.
+    """
+    stats['total'] = 0
+    stats['fetched'] = 0
+    if slices > 1 and oldest_first:
+        history = sliced_history(channel, slices, after)
+    else:
+        history = paced_history(channel, limit=None, after=after, oldest_first=oldest_first)
+    waited = time.perf_counter()
+    async for message in history:
+        metrics.history_wait.observe(time.perf_counter() - waited)
+        metrics.history_messages.inc()
+        stats['total'] += 1
+        try:
+            if message.type in EXPORTABLE_TYPES:
+                stats['fetched'] += 1
+                yield message
+            else:
+                logger.debug('Found a message of type %s.', message.type)
         except Exception as e:
-            logger.error(f'error: {e}')
+            logger.error('error: %s', e)
             pass
-    total_messages = await get_message_count(channel)
-    return messages, total_messages[0], actually_fetched
-
-async def handle_messages(reader, interaction, channel, channel_name, bot, rows, last_import):
-    global should_stop
-    sent = []
-    rows = []
-    for row in reader:
-        rows.append(row)
+        waited = time.perf_counter()
+
+async def fetch_messages(channel):
+    """
+    Fetches the exportable messages of a channel in a single pass over its history.
+    Prefer export_messages for exports, which never holds the whole channel in memory.
+    :param channel: Channel to fetch messages from.
+    :return: Tuple of messages (oldest first), total message count and exported message count.
+    """
+    stats = {}
+    messages = [message async for message in stream_messages(channel, stats, oldest_first=True)]
+    return messages, stats['total'], stats['fetched']
+
+class RowCursor:
+    """
+    Streams csv rows from a binary file while tracking the byte offset each row starts at.
+    Offsets are only kept for rows that have been read but not yet passed, so memory stays bounded by the import's lookahead.
+    """
+    def __init__(self, file, start=0):
+        """
+        :param file: Binary file object to read from.
+        :param start: Byte offset to start reading at.
+        """
+        self.file = file
+        self.file.seek(start)
+        self.offset = start
+        self.rownum = -1
+        self.offsets = collections.OrderedDict()
+        self.reader = csv.reader(self._lines())
+        self.version = codec.LEGACY_VERSION
+        if start == 0:
+            self._read_marker()
+
+    def _read_marker(self):
+        try:
+            row = next(self.reader)
+        except StopIteration:
+            return
+        version = codec.read_version(row)
+        if version is not None:
+            self.version = version
+        else:
+            # legacy export, the first row is a message
+            self.file.seek(0)
+            self.offset = 0
+            self.reader = csv.reader(self._lines())
+
+    def _lines(self):
+        for line in iter(self.file.readline, b''):
+            self.offset += len(line)
+            yield line.decode('utf-8')
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        row_offset = self.offset
+        row = next(self.reader)
+        self.rownum += 1
+        self.offsets[self.rownum] = row_offset
+        return self.rownum, row
+
+    def offset_of(self, rownum: int) -> int:
+        """
+        Gets the byte offset a row starts at, forgetting the offsets of every earlier row.
+        :param rownum: Row number, as yielded by the cursor.
+        :return: Byte offset.
+        """
+        while self.offsets and next(iter(self.offsets)) < rownum:
+            self.offsets.popitem(last=False)
+        return self.offsets.get(rownum, self.offset)
+
+    def seek(self, position: int):
+        """
+        Moves the cursor to a position returned by offset_of.
+        :param position: Byte offset of a row.
+        :return: Void
+        """
+        self.file.seek(position)
+        self.offset = position
+        self.offsets.clear()
+        self.reader = csv.reader(self._lines())
+
+    def find(self, message_id: int):
+        """
+        Csv exports have no message id index, so messages can only be found by reading through them.
+        :return: None
+        """
+        return None
+
+    def size(self) -> int:
+        position = self.file.tell()
+        size = self.file.seek(0, os.SEEK_END)
+        self.file.seek(position)
+        return size
+
+def open_rows(file, start=0):
+    """
+    Opens an export for importing, whether it is a csv file or a compressed archive.
+    :param file: Binary file object of the export.
+    :param start: Position to start reading at, as returned by offset_of.
+    :return: RowCursor or archive.ArchiveReader.
+    """
+    if archive.is_archive(file):
+        return archive.ArchiveReader(file, start)
+    return RowCursor(file, start)
+
+def export_path(channel_id) -> str:
+    """
+    Gets the export file of a channel. If it was exported both as a csv file and as a compressed archive, the newer one is used.
+    :param channel_id: Id of the exported channel.
+    :return: Path of the export.
+    """
+    paths = [path for path in (f'{channel_id}.csv', f'{channel_id}{archive.ARCHIVE_EXTENSION}') if os.path.exists(path)]
+    if not paths:
+        return f'{channel_id}.csv'
+    return max(paths, key=os.path.getmtime)
+
+MAX_EMBEDS = 10
+MAX_EMBED_CHARACTERS = 6000
+MAX_EMBED_DESCRIPTION = 4096
+
+def plan_followups(embeds: list, reactions: list, large_files: list):
+    """
+    Folds the follow-ups of a message into its own embeds as far as Discord's limits (10 embeds, 6000 characters) allow,
+    saving a request for each follow-up that fits.
+    :param embeds: Embeds the message will be sent with, extended in place.
+    :param reactions: Decoded reactions column of the message.
+    :param large_files: Urls of the attachments that are too large to upload.
+    :return: Tuple of the reaction embed still to be sent as a reply (or None), the large file urls still to be sent
+    separately and the large file urls that were folded into the embeds.
+    """
+    characters = sum(len(embed) for embed in embeds)
+    folded_links = []
+    if large_files and len('\n'.join(large_files)) <= MAX_EMBED_DESCRIPTION:
+        links = em.Message.large_files(large_files)
+        if len(embeds) < MAX_EMBEDS and characters + len(links) <= MAX_EMBED_CHARACTERS:
+            embeds.append(links)
+            characters += len(links)
+            folded_links, large_files = large_files, []
+    reaction_embed = None
+    if reactions:
+        reaction_embed = em.Message.emoji_display(reactions, attached=True)
+        if len(embeds) < MAX_EMBEDS and characters + len(reaction_embed) <= MAX_EMBED_CHARACTERS:
+            embeds.append(reaction_embed)
+            reaction_embed = None
+        else:
+            reaction_embed = em.Message.emoji_display(reactions)
+    return reaction_embed, large_files, folded_links
+
+async def pin_messages(channel, message_ids: list):
+    """
+    Pins imported messages in one pass, oldest first, so the pins keep their original order.
+    A message that cannot be pinned (e.g. the channel is at its pin limit) is skipped instead of stopping the import.
+    :param channel: Channel or thread the messages were imported into.
+    :param message_ids: Ids of the imported messages to pin.
+    :return: Void
+    """
+    for message_id in message_ids:
+        try:
+            await webhooks.global_budget.acquire()
+            with metrics.followups.time(kind='pin'):
+                await channel.get_partial_message(message_id).pin()
+        except discord.HTTPException as e:
+            logger.warning('Could not pin message %s in %s: %s', message_id, channel.id, e)
+
+async def handle_messages(reader, interaction, channel, channel_name, bot, job, webhook: webhooks.WebhookPool = None, resumable=True, restart=False) -> int:
+    """
+    Posts the rows of an export into a channel or thread, strictly in order.
+    :param reader: RowCursor or ArchiveReader to import from.
+    :param interaction: Interaction that started the import.
+    :param channel: Channel or thread to post to.
+    :param channel_name: Name the import journal is kept under.
+    :param bot: Bot the webhooks belong to.
+    :param job: Job the import runs in.
+    :param webhook: Pool shared with other imports. If not given, a pool is created for this import, deleted at the end,
+    and the result is reported to the user.
+    :param resumable: Whether a run that stops keeps its journal so that running the import again into the same channel
+    resumes after the last posted row. Imports that post into a channel created for the run can never resume, and delete it.
+    :param restart: Start over instead of resuming a journal left by an earlier run.
+    :return: Number of rows imported.
+    :raises ImportSourceChangedException: If a journal left by an earlier run was written for a different source.
+    :raises ImportStoppedException: If a row could not be imported.
+    """
+    sent = ImportJournal(f'{channel_name}_{channel.id}_journal.csv', reader.file, reader.size(), restart)
+    if sent.position is not None:
+        # skip straight past the last row that was posted before the restart
+        reader.seek(sent.position)
+        next(reader)
     thread_doodad = discord.utils.MISSING
     if type(channel) == discord.Thread:
-        webhook = await channel.parent.create_webhook(name='zerahook', avatar=None)
         thread_doodad = channel
-    else:
-        webhook = await channel.create_webhook(name=f'zerahook', avatar=None)
-    timeprev = None
+    owns_webhook = webhook is None
+    if owns_webhook:
+        webhook = await webhooks.WebhookPool.create(channel, get_http_session(), bot)
+    timeprev = datetime.datetime.now()
     timepost = None
-    for rownum, row in enumerate(rows):
-        if should_stop:
-            if row[5] != 0:
+    max_size = 8_000_000 if bot.get_guild(interaction.guild_id).premium_tier < 2 else 50_000_000
+    prefetcher = AttachmentPrefetcher(reader, max_size, reader.version)
+    imported = 0
+    async for rownum, row, downloads in prefetcher:
+        if job.cancelled:
+            sent.close(delete=not resumable)
+            prefetcher.close()
+            if owns_webhook:
                 await webhook.delete()
-                rows2 = rows[rownum:]
-                with open(f'{channel_name}_in_progress.csv', 'w', newline='', encoding='utf-8') as file2:
-                    writer = csv.writer(file2)
-                    for row2 in rows2:
-                        writer.writerow(row2)
-                rows = []
-                should_stop = False
-                await interaction.user.send('Import cancelled.')
-                return
-        print("rownum = " + str(rownum))
-        if rownum == 0:
-            timeprev = datetime.datetime.now()
+                await interaction.user.send(f'Import job {job.id} cancelled. Run the import again to resume it.')
+            return imported
         try:
             author_name, author_avatar_url, content, embeds, original_id, reference_id, inter_name, inter_user, reactions, attachments, stickers, components, pin_flag, thread_flag = row
 
@@ -295,45 +1063,48 @@ async def handle_messages(reader, interaction, channel, channel_name, bot, rows,
                 else:
                     # embed=em.Thread.thread_sysmessage(author_name)
                     # test = await webhook.send(content="** **", username=f'{author_name} started a thread.', avatar_url=author_avatar_url, wait=True)
+                    await webhooks.global_budget.acquire()
                     thread = await channel.create_thread(name=content, type=discord.ChannelType.public_thread, reason='Thread import')
+                    await webhooks.global_budget.acquire()
                     await channel.last_message.delete()
                     await webhook.send(embed=em.Thread.thread_sysmessage(author_name, author_avatar_url, thread.jump_url, thread.name), username=author_name, avatar_url=author_avatar_url, thread=thread_doodad)
-                if rownum == len(rows) - 1:
-                    timepost = datetime.datetime.now()
+                sent.commit(reader.offset_of(rownum), original_id)
+                imported += 1
+                job.progress += 1
+                metrics.imported_rows.inc()
                 continue
 
             embeds2 = []
-            embeds = eval(embeds)
+            embeds = codec.decode_column(embeds, reader.version)
             for i in range(len(embeds)):
                 embed = dict(embeds[i])
                 embeds2.append(discord.Embed.from_dict(embed))
             
-            files = []
-            large_files = []
-            if attachments != '[]':
-                for attachment in eval(attachments):
-                    filedata = await read_attachment_url(attachment)
-                    if filedata[1] > 8_000_000 and bot.get_guild(interaction.guild_id).premium_tier < 2:
-                        logger.debug('An attachment was too large!')
-                        large_files.append(attachment)
-                        continue
-                    elif filedata[1] > 50_000_000:
-                        logger.debug('An attachment was too large!')
-                        large_files.append(attachment)
-                        continue
-                    else:
-                        files.append(discord.File(filedata[0], filename=re.match(r'.*/(.*\.\w+)', attachment)[0]))
-            if stickers != '[]':
-                    for sticker in eval(stickers):
-                        filedata = await read_attachment_url(sticker)
-                        files.append(discord.File(filedata[0], filename=re.match(r'.*/(.*\.\w+)', sticker)[0]))
+            files, large_files = await downloads
             # split files into a list of lists of 10 files
             files = [files[i:i + 10] for i in range(0, len(files), 10)] if files else [[]]
 
+            reply_target = None
+            if int(reference_id) != 0:
+                reply_target_id = sent.get(reference_id)
+                if reply_target_id:
+                    reply_target = channel.get_partial_message(reply_target_id)
+                # the replied-to message has no imported copy to reply to, post it as a regular message instead
+                if not reply_target and len(embeds2) < 10:
+                    # archives can tell a target that is in the export but was posted as nothing replyable (such as a thread sysmessage) from one outside of it
+                    target_rownum = reader.find(int(reference_id))
+                    if target_rownum is not None:
+                        target = reader.row(target_rownum)
+                        embeds2.insert(0, em.Message.unrepliable_reply(target[0], target[1], target[2]))
+                    else:
+                        embeds2.insert(0, em.Message.orphaned_reply())
+                elif reply_target:
+                    embeds2.insert(0, em.Message.reply_message(author_name, author_avatar_url, content, len(embeds) > 1))
+
             # handle components
             view = None
             if components != '[]':
-                components = ast.literal_eval(components)
+                components = codec.decode_column(components, reader.version)
                 complist = []
                 rowcount = 0
                 for comp in components:
@@ -344,45 +1115,20 @@ async def handle_messages(reader, interaction, channel, channel_name, bot, rows,
                     else:
                         complist.append(dict_to_component(comp, rowcount -1))
                 view = view_with_components(complist)
+
+            # fold the reactions and large file links into the message itself where the embed limits allow
+            reaction_embed, large_files, folded_links = plan_followups(embeds2, codec.decode_column(reactions, reader.version), large_files)
+
             # handle reply messages
-            elif int(reference_id) != 0:
-                for message, original_id in sent:
-                    if original_id == reference_id:
-                        embeds2.insert(0, em.Message.reply_message(author_name, author_avatar_url, content, len(embeds) > 1))
-                        message2 = await message.reply(embeds=embeds2, files=files[0] if files else None, view=view if view else EmptyView())
-                        for i, filelist in enumerate(files):
-                            if i == 0:
-                                pass
-                            else:
-                                await webhook.send(files=filelist, username=author_name, avatar_url=author_avatar_url, thread=thread_doodad)
-                        if (large_files):
-                            message_text = ''
-                            for large_file in large_files:
-                                message_text += large_file + '\n'
-                            await webhook.send(content=message_text, username=author_name, avatar_url=author_avatar_url, thread=thread_doodad)
-                        break
+            if reply_target:
+                await webhooks.global_budget.acquire()
+                message2 = await reply_target.reply(embeds=embeds2, files=files[0] if files else None, view=view if view else EmptyView())
             # handle interaction messages
             elif inter_name != '0':
                 try:
                     message2 = await webhook.send(content=content, embeds=embeds2, username=f'{inter_user} used {inter_name}', avatar_url=author_avatar_url, files=files[0] if files else None, view=view if view else EmptyView(), wait=True, thread=thread_doodad)
                 except Exception as e:
                     message2 = None
-                for i, filelist in enumerate(files):
-                    if i == 0:
-                        pass
-                    else:
-                        if not message2:
-                            message2 = await webhook.send(files=filelist, username=author_name, avatar_url=author_avatar_url, wait=True, thread=thread_doodad)
-                        else:
-                            await webhook.send(files=filelist, username=author_name, avatar_url=author_avatar_url, thread=thread_doodad)
-                if (large_files):
-                    message_text = ''
-                    for large_file in large_files:
-                        message_text += large_file + '\n'
-                    if not message2:
-                        message = await webhook.send(content=message_text, username=author_name, avatar_url=author_avatar_url, wait=True, thread=thread_doodad)
-                    else:
-                        await webhook.send(content=message_text, username=author_name, avatar_url=author_avatar_url, thread=thread_doodad)
             # handle normal messages
             else:
                 try:
@@ -392,46 +1138,49 @@ async def handle_messages(reader, interaction, channel, channel_name, bot, rows,
                         for con_slice in contents[1:]:
                             await webhook.send(content=con_slice, username=author_name, avatar_url=author_avatar_url, wait=True, thread=thread_doodad)
                 except Exception as e:
-                    print(f'message2 error: {e}')
+                    logger.warning('message2 error: %s', e)
                     message2 = None
-                for i, filelist in enumerate(files):
-                    if i == 0:
-                        pass
-                    else:
-                        if not message2:
-                            message2 = await webhook.send(files=filelist, username=author_name, avatar_url=author_avatar_url, wait=True, thread=thread_doodad)
-                        else:
-                            await webhook.send(files=filelist, username=author_name, avatar_url=author_avatar_url, thread=thread_doodad)
-                if (large_files):
-                    message_text = ''
-                    for large_file in large_files:
-                        message_text += large_file + '\n'
-                    if not message2:
-                        message2 = await webhook.send(content=message_text, username=author_name, avatar_url=author_avatar_url, wait=True, thread=thread_doodad)
-                    else:
-                        await webhook.send(content=message_text, username=author_name, avatar_url=author_avatar_url, thread=thread_doodad)
-            sent.append((message2, original_id))
-            if int(pin_flag) == 1:
-                await message2.pin()
-            # send secondary messages with the reactions
-            if reactions != '[]':
-                await message2.reply(embed=em.Message.emoji_display(eval(reactions)))
-            last_import = rownum
+            if not message2:
+                # the links were folded into a message that could not be posted
+                large_files = folded_links + large_files
+            # more than 10 files do not fit in one message
+            for filelist in files[1:]:
+                if not message2:
+                    message2 = await webhook.send(files=filelist, username=author_name, avatar_url=author_avatar_url, wait=True, thread=thread_doodad)
+                else:
+                    await webhook.send(files=filelist, username=author_name, avatar_url=author_avatar_url, thread=thread_doodad)
+            if large_files:
+                message_text = ''.join(large_file + '\n' for large_file in large_files)
+                if not message2:
+                    message2 = await webhook.send(content=message_text, username=author_name, avatar_url=author_avatar_url, wait=True, thread=thread_doodad)
+                else:
+                    await webhook.send(content=message_text, username=author_name, avatar_url=author_avatar_url, thread=thread_doodad)
+            # pins are deferred to one pass at the end of the import, through the journal so they survive a restart
+            sent.commit(reader.offset_of(rownum), original_id, message2.id if message2 else 0, int(pin_flag) == 1)
+            # reactions that did not fit into the message are still sent as a reply
+            if reaction_embed:
+                await webhooks.global_budget.acquire()
+                with metrics.followups.time(kind='reactions'):
+                    await message2.reply(embed=reaction_embed)
         except Exception as e:
-            print(e)
-            print(row)
-            print(rownum)
-            with open(f'badexit.csv', 'w', newline='', encoding='utf-8') as file2:
-                writer = csv.writer(file2)
-                rows2 = rows[rownum:]
-                for row in rows2:
-                    writer.writerow(row)
-            return
-        if rownum == len(rows) - 1:
-                timepost = datetime.datetime.now()
-    if os.path.exists(f'{channel_name}_in_progress.csv'):
-        os.remove(f'{channel_name}_in_progress.csv')
-    await webhook.delete()
-    await interaction.user.send(f'Imported {len(rows)} messages in {timepost - timeprev} seconds.')
-    rows = []
+            logger.error('Import of %s stopped at row %d%s: %s', channel_name, rownum, ', run it again to resume from there' if resumable else '', e)
+            logger.debug('Failed row: %s', row)
+            sent.close(delete=not resumable)
+            prefetcher.close()
+            if owns_webhook:
+                await webhook.delete()
+            raise ImportStoppedException(channel_name, rownum, e)
+        imported += 1
+        job.progress += 1
+        metrics.imported_rows.inc()
+    await pin_messages(channel, sent.pins)
+    timepost = datetime.datetime.now()
+    sent.close(delete=True)
+    prefetcher.close()
+    if owns_webhook:
+        await webhook.delete()
+        report = webhook.report()
+        logger.info(report)
+        await interaction.user.send(f'Imported {imported} messages in {timepost - timeprev} seconds.\n{report}')
+    return imported
 
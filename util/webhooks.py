@@ -0,0 +1,181 @@
+import asyncio
+import os
+import re
+import time
+import aiohttp
+import discord
+from util import log_helper, metrics
+
+logger = log_helper.get_logger(__name__)
+
+WEBHOOK_POOL_SIZE = int(os.getenv('ZERABOT_WEBHOOK_POOL_SIZE', 3))
+# stays under Discord's global limit of 50 requests per second, shared by every job
+GLOBAL_REQUESTS_PER_SECOND = float(os.getenv('ZERABOT_GLOBAL_REQUESTS_PER_SECOND', 40))
+WEBHOOK_URL = re.compile(r'/webhooks/(\d+)/')
+
+
+class BucketStats:
+    """
+    Throughput counters for a single webhook rate limit bucket.
+    """
+    def __init__(self):
+        self.requests = 0
+        self.rate_limited = 0
+        self.waited = 0.0
+
+
+class RateLimitTracker:
+    """
+    Reads Discord's rate limit headers off every webhook response made through a traced aiohttp session.
+    """
+    def __init__(self):
+        self.ready_at = {}
+        self.buckets = {}
+        self.stats = {}
+        self.global_ready_at = 0.0
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        """
+        Creates the trace config to attach to the session webhooks are sent through.
+        :return: aiohttp.TraceConfig
+        """
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_end.append(self._on_request_end)
+        return trace_config
+
+    def stats_for(self, webhook_id: int) -> BucketStats:
+        bucket = self.buckets.get(webhook_id, str(webhook_id))
+        if bucket not in self.stats:
+            self.stats[bucket] = BucketStats()
+        return self.stats[bucket]
+
+    async def _on_request_end(self, session, context, params):
+        match = WEBHOOK_URL.search(params.url.path)
+        if not match:
+            return
+        webhook_id = int(match[1])
+        headers = params.response.headers
+        now = time.monotonic()
+        if 'X-RateLimit-Bucket' in headers:
+            self.buckets[webhook_id] = headers['X-RateLimit-Bucket']
+        stats = self.stats_for(webhook_id)
+        stats.requests += 1
+        if params.response.status == 429:
+            stats.rate_limited += 1
+            metrics.rate_limited.inc()
+            retry_after = float(headers.get('Retry-After', 1))
+            if headers.get('X-RateLimit-Global'):
+                self.global_ready_at = now + retry_after
+            self.ready_at[webhook_id] = now + retry_after
+        elif headers.get('X-RateLimit-Remaining') == '0':
+            self.ready_at[webhook_id] = now + float(headers.get('X-RateLimit-Reset-After', 0))
+        else:
+            self.ready_at[webhook_id] = now
+
+    def ready_time(self, webhook_id: int) -> float:
+        return max(self.ready_at.get(webhook_id, 0.0), self.global_ready_at)
+
+
+class RequestBudget:
+    """
+    Spaces requests out evenly so that all concurrent jobs together stay under a global rate.
+    Jobs take a slot for every request they make: webhook sends, replies, pins, thread creation and deletion, and every
+    page of channel history (see utility.paced_history). One-off calls such as DMs and user lookups go around it.
+    """
+    def __init__(self, per_second=GLOBAL_REQUESTS_PER_SECOND):
+        self.interval = 1 / per_second
+        self.next_slot = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            now = time.monotonic()
+            delay = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if delay > 0:
+            metrics.rate_limit_wait.observe(delay)
+            await asyncio.sleep(delay)
+
+
+rate_limits = RateLimitTracker()
+global_budget = RequestBudget()
+
+
+class WebhookPool:
+    """
+    Small pool of webhooks for one channel that sends through whichever webhook's rate limit bucket frees up first.
+    Each caller still sends one message at a time, so message order is preserved. Several callers (e.g. the threads of
+    a forum import) may share one pool, the pool only decides which webhook each send goes through.
+    """
+    def __init__(self, webhooks, owned):
+        self.webhooks = webhooks
+        self.owned = owned
+        self.last_used = {webhook.id: 0.0 for webhook in webhooks}
+        self.lock = asyncio.Lock()
+        self.sent = 0
+        self.started = time.monotonic()
+
+    @classmethod
+    async def create(cls, channel, session: aiohttp.ClientSession, client, size=WEBHOOK_POOL_SIZE):
+        """
+        Creates a pool of webhooks on a channel, or on a thread's parent channel.
+        :param channel: Channel (or thread) the pool will post to.
+        :param session: Session whose trace config reports to rate_limits.
+        :param client: Bot the webhooks belong to.
+        :param size: Number of webhooks to create. Fewer are used if the channel's webhook limit is reached.
+        :return: WebhookPool
+        """
+        parent = channel.parent if type(channel) == discord.Thread else channel
+        owned = []
+        for i in range(max(1, size)):
+            try:
+                owned.append(await parent.create_webhook(name='zerahook', avatar=None))
+            except discord.HTTPException as e:
+                if not owned:
+                    raise
+                logger.warning('Could only create %d webhooks in %s: %s', len(owned), parent.id, e)
+                break
+        webhooks = [discord.Webhook.partial(webhook.id, webhook.token, session=session, client=client) for webhook in owned]
+        return cls(webhooks, owned)
+
+    async def _acquire(self) -> discord.Webhook:
+        async with self.lock:
+            webhook = min(self.webhooks, key=lambda w: (rate_limits.ready_time(w.id), self.last_used[w.id]))
+            delay = rate_limits.ready_time(webhook.id) - time.monotonic()
+            if delay > 0:
+                rate_limits.stats_for(webhook.id).waited += delay
+                metrics.rate_limit_wait.observe(delay)
+                await asyncio.sleep(delay)
+            self.last_used[webhook.id] = time.monotonic()
+            return webhook
+
+    async def send(self, *args, **kwargs):
+        """
+        Sends a message through the webhook whose bucket is ready first. Accepts the same arguments as discord.Webhook.send.
+        :return: Whatever discord.Webhook.send returns.
+        """
+        webhook = await self._acquire()
+        await global_budget.acquire()
+        with metrics.webhook_sends_in_flight.track(), metrics.webhook_sends.time():
+            message = await webhook.send(*args, **kwargs)
+        self.sent += 1
+        return message
+
+    async def delete(self):
+        for webhook in self.owned:
+            try:
+                await webhook.delete()
+            except discord.HTTPException as e:
+                logger.warning('Could not delete webhook %s: %s', webhook.id, e)
+
+    def report(self) -> str:
+        """
+        Summarises throughput and rate limiting for every bucket used by the pool.
+        :return: Human readable report.
+        """
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        lines = [f'Sent {self.sent} webhook messages through {len(self.webhooks)} webhooks ({self.sent / elapsed * 60:.1f} messages/min).']
+        for webhook in self.webhooks:
+            stats = rate_limits.stats_for(webhook.id)
+            lines.append(f'Webhook {webhook.id}: {stats.requests} requests, {stats.rate_limited} rate limited, {stats.waited:.1f}s waited.')
+        return '\n'.join(lines)